@@ -0,0 +1,484 @@
+# bench.py
+# Офлайн-нагрузка на настоящие хендлеры bot.py — без токена и без Telegram.
+#   python bench.py --users 200 --tasks 20 --clicks 50 --storage sqlite
+# Bot API подменяется локальным FakeRequest, данные пишутся во временный DATA_DIR.
+# Отчёт: апдейты/с, p50/p99 задержки хендлеров, байты записи на апдейт, опоздание напоминаний.
+#   python bench.py --workers 4 --users 500
+# --workers N > 1: настоящий фронт + N процессов-воркеров (WORKERS=N в bot.py); апдейты идут
+# HTTP-запросами во фронт, Bot API — фейковый HTTP-сервер здесь же (TG_API_URL). Проверяется и
+# порядок ответов внутри каждого чата.
+
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Any, List, Optional
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Офлайн-бенчмарк хендлеров bot.py")
+    p.add_argument("--users", type=int, default=100, help="сколько пользователей")
+    p.add_argument("--tasks", type=int, default=10, help="задач на пользователя (/new)")
+    p.add_argument("--clicks", type=int, default=30, help="нажатий кнопок на пользователя")
+    p.add_argument("--reminders", type=int, default=3, help="сколько задач пользователя ставить на t:rem5m")
+    p.add_argument("--rem-interval", type=float, default=2.0, help="интервал напоминаний в фазе срабатывания, с")
+    p.add_argument("--rem-seconds", type=float, default=5.0, help="сколько секунд гонять срабатывания (0 — пропустить)")
+    p.add_argument("--digest-window", type=float, default=0.0,
+                   help="REM_DIGEST_WINDOW для bot.py, с (0 — по сообщению на напоминание)")
+    p.add_argument("--concurrency", type=int, default=64, help="апдейтов в обработке одновременно")
+    p.add_argument("--api-latency", type=float, default=0.0, help="искусственная задержка ответа Bot API, мс")
+    p.add_argument("--storage", default="json", help="STORAGE для bot.py (json | sqlite | journal)")
+    p.add_argument("--data-dir", default=None, help="DATA_DIR (по умолчанию — временная папка)")
+    p.add_argument("--workers", type=int, default=1,
+                   help="> 1 — многопроцессный режим: фронт + воркеры по HTTP (без фазы напоминаний)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", action="store_true", help="вывести отчёт в JSON (для сравнения прогонов)")
+    p.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    return p.parse_args()
+
+
+def load_bot(args: argparse.Namespace):
+    # окружение должно быть выставлено до импорта: bot.py читает его на уровне модуля
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="taskbot-bench-")
+    os.environ["DATA_DIR"] = data_dir
+    os.environ["STORAGE"] = args.storage
+    os.environ.setdefault("TG_BOT_TOKEN", "123456:BENCH")
+    # очередь отправки не должна упираться в лимиты Telegram — их тут нет
+    os.environ.setdefault("SEND_RATE", "1000000")
+    os.environ.setdefault("SEND_CHAT_RATE", "1000000")
+    os.environ.setdefault("REM_TICK", "0.1")
+    os.environ["REM_DIGEST_WINDOW"] = str(args.digest_window)
+    bot = importlib.import_module("bot")
+    if not args.verbose:
+        bot.logger.setLevel(logging.WARNING)
+    return bot, data_dir
+
+
+def fake_result(name: str, params: Dict[str, Any], msg_id: int) -> Any:
+    # правдоподобный result для методов, которые зовёт бот
+    if name == "getMe":
+        return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+    if name in ("sendMessage", "editMessageText", "sendDocument"):
+        return {
+            "message_id": int(params.get("message_id", msg_id)),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 1)), "type": "private"},
+            "text": params.get("text", ""),
+        }
+    return True
+
+
+def make_fake_request(bot_module, api_latency: float):
+    from telegram.request import BaseRequest
+
+    class FakeRequest(BaseRequest):
+        # Локальная замена HTTP-бэкенда Bot API: отвечает правдоподобными объектами и считает вызовы
+        def __init__(self) -> None:
+            self.calls: Dict[str, int] = {}
+            self._msg_id = 1000
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        @property
+        def read_timeout(self) -> Optional[float]:
+            return 5.0
+
+        async def do_request(self, url, method, request_data=None, **kwargs):
+            name = url.rsplit("/", 1)[-1]
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if api_latency:
+                await asyncio.sleep(api_latency / 1000)
+            self._msg_id += 1
+            result = fake_result(name, request_data.parameters if request_data else {}, self._msg_id)
+            return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+    return FakeRequest()
+
+
+class UpdateFactory:
+    # Синтетические апдейты в формате Bot API; tg_bot=None — только JSON (для отправки по HTTP)
+    def __init__(self, tg_bot=None) -> None:
+        self.bot = tg_bot
+        self.update_id = 0
+        self.card_msg: Dict[int, int] = {}
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+
+    def message_json(self, user_id: int, text: str) -> Dict[str, Any]:
+        self.update_id += 1
+        entities = []
+        if text.startswith("/"):
+            entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {
+            "update_id": self.update_id,
+            "message": {
+                "message_id": self.update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                "text": text,
+                "entities": entities,
+            },
+        }
+
+    def click_json(self, user_id: int, data: str) -> Dict[str, Any]:
+        self.update_id += 1
+        # все нажатия пользователя приходят с одной «карточки», как в живом чате
+        msg_id = self.card_msg.setdefault(user_id, 10_000_000 + user_id)
+        return {
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id),
+                "chat_instance": str(user_id),
+                "from": self._user(user_id),
+                "data": data,
+                "message": {
+                    "message_id": msg_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "…",
+                },
+            },
+        }
+
+    def message(self, user_id: int, text: str):
+        from telegram import Update
+        return Update.de_json(self.message_json(user_id, text), self.bot)
+
+    def click(self, user_id: int, data: str):
+        from telegram import Update
+        return Update.de_json(self.click_json(user_id, data), self.bot)
+
+
+# Кнопки как на живых клавиатурах: компактный формат bot.cb() ("2p5" = cb("+10", 5)) — его шлют
+# все новые сообщения; плюс немного старых строк "t:..."/"ui:..." с уже отправленных карточек.
+CLICK_ACTIONS = ["2p{tid}", "2p{tid}", "2d{tid}", "2o{tid}", "2z{tid}",
+                 "2l", "2l1", "2m", "2_", "2a{tid}",
+                 "t:+10:{tid}", "ui:list:1", "noop"]
+
+
+def check_click_actions(bot) -> None:
+    # шаблоны выше должны совпадать с тем, что сейчас кодирует bot.cb
+    for template in CLICK_ACTIONS:
+        action, args = bot.decode_cb(template.format(tid=1))
+        if not action or (not template.startswith(("t:", "ui:", "noop")) and bot.cb(action, *args) != template.format(tid=1)):
+            raise SystemExit(f"CLICK_ACTIONS: {template!r} не разбирается текущим bot.py")
+
+
+def pct(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def run_phase(bot, app, fake, name: str, updates: list, concurrency: int) -> Dict[str, Any]:
+    sem = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    calls_before = sum(fake.calls.values())
+    bytes_before = bot.storage.bytes_written
+
+    async def one(update) -> None:
+        async with sem:
+            started = time.perf_counter()
+            await app.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(u) for u in updates))
+    handled = time.perf_counter() - started
+    # write-behind: байты считаем после сброса кэша, время сброса — отдельно
+    flush_started = time.perf_counter()
+    await bot.flush_tasks()
+    flushed = time.perf_counter() - flush_started
+    n = len(updates) or 1
+    return {
+        "phase": name,
+        "updates": len(updates),
+        "seconds": round(handled, 3),
+        "updates_per_sec": round(len(updates) / handled, 1) if handled else 0.0,
+        "p50_ms": round(pct(latencies, 50) * 1000, 3),
+        "p99_ms": round(pct(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies, default=0) * 1000, 3),
+        "flush_ms": round(flushed * 1000, 3),
+        "bytes_per_update": round((bot.storage.bytes_written - bytes_before) / n, 1),
+        "api_calls_per_update": round((sum(fake.calls.values()) - calls_before) / n, 2),
+    }
+
+
+async def run_firing(bot, app, fake, args, user_ids: List[int], rng: random.Random) -> Dict[str, Any]:
+    # переставляем все напоминания на короткий интервал со случайной фазой и даём им сработать
+    lags: List[float] = []
+    bot.reminders.lag_observers.append(lags.append)
+    before = bot.reminders.stats()
+    sent_before = bot.outbox.sent
+    for user_id in user_ids:
+        data = await bot.load_tasks(user_id)
+        for sid, t in data["tasks"].items():
+            if t.get("reminder_interval"):
+                first = rng.uniform(0, args.rem_interval)
+                bot._schedule_reminder(app, user_id, int(sid), args.rem_interval, first=first)
+    await asyncio.sleep(args.rem_seconds)
+    bot.reminders.lag_observers.remove(lags.append)
+    after = bot.reminders.stats()
+    return {
+        "phase": "fire",
+        "active": after["active"],
+        "fired": after["fired"] - before["fired"],
+        "late": after["late"] - before["late"],
+        "sent": bot.outbox.sent - sent_before,
+        "lag_p50_ms": round(pct(lags, 50) * 1000, 1),
+        "lag_p99_ms": round(pct(lags, 99) * 1000, 1),
+        "lag_max_ms": round(max(lags, default=0) * 1000, 1),
+    }
+
+
+async def bench(args: argparse.Namespace) -> Dict[str, Any]:
+    bot, data_dir = load_bot(args)
+    check_click_actions(bot)
+    rng = random.Random(args.seed)
+    fake = make_fake_request(bot, args.api_latency)
+    app = bot.make_app(request=fake)
+    bot.register_handlers(app)
+    bot.schedule_jobs(app)
+
+    errors = []
+    counter = logging.Handler(logging.ERROR)
+    counter.emit = errors.append
+    bot.logger.addHandler(counter)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    factory = UpdateFactory(app.bot)
+    user_ids = [100_000 + i for i in range(args.users)]
+    phases = []
+    try:
+        create = [factory.message(u, f"/new Задача {i}") for i in range(args.tasks) for u in user_ids]
+        phases.append(await run_phase(bot, app, fake, "create", create, args.concurrency))
+
+        clicks = []
+        for _ in range(args.clicks):
+            for u in user_ids:
+                tid = rng.randint(1, max(1, args.tasks))
+                clicks.append(factory.click(u, rng.choice(CLICK_ACTIONS).format(tid=tid)))
+        phases.append(await run_phase(bot, app, fake, "click", clicks, args.concurrency))
+
+        schedules = [factory.click(u, f"t:rem5m:{tid}")
+                     for tid in range(1, min(args.tasks, args.reminders) + 1) for u in user_ids]
+        phases.append(await run_phase(bot, app, fake, "schedule", schedules, args.concurrency))
+
+        if args.rem_seconds > 0:
+            phases.append(await run_firing(bot, app, fake, args, user_ids, rng))
+    finally:
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "verbose")},
+        "data_dir": data_dir,
+        "phases": phases,
+        "api_calls": dict(sorted(fake.calls.items())),
+        "edits": dict(bot.edit_stats),
+        "loop_lag_max_ms": round(bot.loop_lag.max * 1000, 1),
+        "errors": len(errors),
+    }
+
+
+# ---------- многопроцессный режим (--workers N) ----------
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeBotApi:
+    # HTTP-двойник Bot API: воркеры ходят в него через TG_API_URL; тексты запоминаются по чатам
+    def __init__(self, api_latency: float) -> None:
+        self.api_latency = api_latency
+        self.calls: Dict[str, int] = {}
+        self.texts: Dict[int, List[str]] = {}
+        self._msg_id = 1000
+
+    def web_app(self):
+        import tornado.web
+        api = self
+
+        class MethodHandler(tornado.web.RequestHandler):
+            async def post(self, name: str) -> None:
+                # PTB шлёт параметры формой (urlencoded или multipart) — tornado разбирает обе
+                params = {k: v[-1].decode("utf-8") for k, v in self.request.body_arguments.items()}
+                api.calls[name] = api.calls.get(name, 0) + 1
+                if api.api_latency:
+                    await asyncio.sleep(api.api_latency / 1000)
+                if name == "sendMessage":
+                    api.texts.setdefault(int(params["chat_id"]), []).append(params.get("text", ""))
+                api._msg_id += 1
+                self.set_header("Content-Type", "application/json")
+                self.write(json.dumps({"ok": True, "result": fake_result(name, params, api._msg_id)}))
+
+        return tornado.web.Application([(r"/bot[^/]+/(\w+)", MethodHandler)])
+
+    def total(self, *names: str) -> int:
+        return sum(self.calls.get(n, 0) for n in names)
+
+
+async def wait_for(predicate, timeout: float, what: str) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"не дождались: {what}")
+        await asyncio.sleep(0.05)
+
+
+async def run_http_phase(api: FakeBotApi, front_url: str, name: str, per_user: Dict[int, List[Dict[str, Any]]],
+                         done_methods: tuple, concurrency: int, timeout: float) -> Dict[str, Any]:
+    # апдейты одного пользователя идут по очереди (как их шлёт Telegram), пользователи — параллельно;
+    # фаза закончена, когда каждому апдейту ответили методом из done_methods
+    from tornado.httpclient import AsyncHTTPClient
+    client = AsyncHTTPClient(max_clients=concurrency)
+    sem = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    n = sum(len(v) for v in per_user.values())
+    done_before = api.total(*done_methods)
+    calls_before = sum(api.calls.values())
+
+    async def one_user(updates: List[Dict[str, Any]]) -> None:
+        for update in updates:
+            async with sem:
+                started = time.perf_counter()
+                await client.fetch(front_url, method="POST", body=json.dumps(update),
+                                   headers={"Content-Type": "application/json"})
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_user(u) for u in per_user.values()))
+    accepted = time.perf_counter() - started
+    await wait_for(lambda: api.total(*done_methods) - done_before >= n, timeout, f"ответы фазы {name}")
+    handled = time.perf_counter() - started
+    return {
+        "phase": name,
+        "updates": n,
+        "seconds": round(handled, 3),
+        "accept_seconds": round(accepted, 3),
+        "updates_per_sec": round(n / handled, 1) if handled else 0.0,
+        "p50_ms": round(pct(latencies, 50) * 1000, 3),
+        "p99_ms": round(pct(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies, default=0) * 1000, 3),
+        "api_calls_per_update": round((sum(api.calls.values()) - calls_before) / (n or 1), 2),
+    }
+
+
+def order_violations(api: FakeBotApi) -> int:
+    # ответы на /new Задача i в каждом чате должны идти по возрастанию i
+    bad = 0
+    for texts in api.texts.values():
+        seen = [int(m.group(1)) for m in (re.search(r"Задача (\d+)", t) for t in texts) if m]
+        bad += sum(1 for a, b in zip(seen, seen[1:]) if b < a)
+    return bad
+
+
+async def bench_cluster(args: argparse.Namespace) -> Dict[str, Any]:
+    import tornado.httpserver
+    rng = random.Random(args.seed)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="taskbot-bench-")
+    api = FakeBotApi(args.api_latency)
+    api_port, front_port = free_port(), free_port()
+    tornado.httpserver.HTTPServer(api.web_app()).listen(api_port, "127.0.0.1")
+    env = dict(os.environ)
+    env.update({
+        "DATA_DIR": data_dir,
+        "STORAGE": args.storage,
+        "TG_BOT_TOKEN": env.get("TG_BOT_TOKEN", "123456:BENCH"),
+        "TG_API_URL": f"http://127.0.0.1:{api_port}/bot",
+        "PUBLIC_URL": f"http://127.0.0.1:{front_port}",
+        "PORT": str(front_port),
+        "WORKERS": str(args.workers),
+        "WORKER_BASE_PORT": str(free_port()),
+        "SEND_RATE": env.get("SEND_RATE", "1000000"),
+        "SEND_CHAT_RATE": env.get("SEND_CHAT_RATE", "1000000"),
+    })
+    out = None if args.verbose else subprocess.DEVNULL
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    front = subprocess.Popen([sys.executable, bot_path], env=env, stdout=out, stderr=out)
+    front_url = f"http://127.0.0.1:{front_port}/hook"
+    factory = UpdateFactory()
+    user_ids = [100_000 + i for i in range(args.users)]
+    phases = []
+    try:
+        # фронт зарегистрировал вебхук, каждый воркер поднял своё приложение (getMe)
+        await wait_for(lambda: api.calls.get("setWebhook", 0) >= 1 and api.calls.get("getMe", 0) >= args.workers,
+                       60, "старт фронта и воркеров")
+        timeout = 60 + (args.users * (args.tasks + args.clicks)) / 100
+        create = {u: [factory.message_json(u, f"/new Задача {i}") for i in range(args.tasks)] for u in user_ids}
+        phases.append(await run_http_phase(api, front_url, "create", create, ("sendMessage",),
+                                           args.concurrency, timeout))
+        clicks = {u: [factory.click_json(u, rng.choice(CLICK_ACTIONS).format(tid=rng.randint(1, max(1, args.tasks))))
+                      for _ in range(args.clicks)] for u in user_ids}
+        phases.append(await run_http_phase(api, front_url, "click", clicks, ("answerCallbackQuery",),
+                                           args.concurrency, timeout))
+    finally:
+        front.send_signal(signal.SIGTERM)
+        try:
+            front.wait(60)
+        except subprocess.TimeoutExpired:
+            front.kill()
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "verbose")},
+        "data_dir": data_dir,
+        "phases": phases,
+        "api_calls": dict(sorted(api.calls.items())),
+        "order_violations": order_violations(api),
+        "front_exit": front.returncode,
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    cfg = report["config"]
+    print(f"users={cfg['users']} tasks={cfg['tasks']} clicks={cfg['clicks']} storage={cfg['storage']} "
+          f"concurrency={cfg['concurrency']} workers={cfg['workers']}  data_dir={report['data_dir']}")
+    print(f"{'phase':<9}{'updates':>9}{'upd/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'B/upd':>9}{'api/upd':>9}")
+    for ph in report["phases"]:
+        if ph["phase"] == "fire":
+            print(f"fire     active={ph['active']} fired={ph['fired']} late={ph['late']} sent={ph['sent']} "
+                  f"lag p50={ph['lag_p50_ms']}ms p99={ph['lag_p99_ms']}ms max={ph['lag_max_ms']}ms")
+            continue
+        print(f"{ph['phase']:<9}{ph['updates']:>9}{ph['updates_per_sec']:>10}{ph['p50_ms']:>9}"
+              f"{ph['p99_ms']:>9}{ph.get('bytes_per_update', '-'):>9}{ph['api_calls_per_update']:>9}")
+    print(f"api calls: {report['api_calls']}")
+    if "order_violations" in report:
+        # многопроцессный режим: задержки — приём апдейта фронтом, upd/s — до ответа воркера
+        print(f"order violations: {report['order_violations']}  front exit code: {report['front_exit']}")
+        return
+    print(f"edits: {report['edits']}  loop lag max: {report['loop_lag_max_ms']}ms  errors: {report['errors']}")
+
+
+def main() -> None:
+    args = parse_args()
+    report = asyncio.run(bench_cluster(args) if args.workers > 1 else bench(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
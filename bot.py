@@ -1,18 +1,44 @@
 # bot.py
 # Требуется: python-telegram-bot[webhooks,job-queue] >= 21  (см. requirements.txt)
 
+import asyncio
+import atexit
+import bisect
+import copy
+import csv
+import functools
+import heapq
+import io
 import json
 import os
+import queue
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
 import logging
-from logging.handlers import RotatingFileHandler
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Tuple, Set, Iterator, List, Optional, Callable, Awaitable
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.error import BadRequest
+import tornado.httpclient
+import tornado.httpserver
+import tornado.web
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+try:
+    import orjson  # необязательно: быстрее json в разы
+except ImportError:
+    orjson = None
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters
+    ContextTypes, DictPersistence, PersistenceInput, filters
 )
 
 # ---------- ХРАНИЛИЩЕ ДАННЫХ ----------
@@ -24,19 +50,79 @@ DATA_DIR.mkdir(parents=True, exist_ok=True)
 LOGS_DIR = DATA_DIR / "logs"
 LOGS_DIR.mkdir(parents=True, exist_ok=True)
 
+# ---------- ЛОГИ ----------
+# Хендлеры и event loop логи не пишут: запись кладётся в очередь (QueueHandler), а файл и stderr
+# обслуживает фоновый поток QueueListener. Сообщение форматируется уже в этом потоке.
+# События TASK:/REM:/SEND: пишутся через log_event структурно (ключ=значение или JSON при
+# LOG_FORMAT=json); самые частые строки (тик напоминания, успешная отправка) можно
+# прореживать: LOG_SAMPLE=0.01 оставит примерно каждую сотую.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "100000"))
+LOG_SAMPLE = float(os.getenv("LOG_SAMPLE", "1"))
+
+class EventFields:
+    # k=v рендерится только при форматировании, т.е. в потоке логов и только если запись прошла уровень
+    __slots__ = ("fields",)
+
+    def __init__(self, fields: Dict[str, Any]) -> None:
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return " ".join(f"{k}={v}" for k, v in self.fields.items())
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out: Dict[str, Any] = {"ts": self.formatTime(record), "level": record.levelname}
+        event = getattr(record, "event", None)
+        if event is not None:
+            out["event"] = event
+            out.update(record.fields)
+        else:
+            out["msg"] = record.getMessage()
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class LogQueueHandler(QueueHandler):
+    def __init__(self, q: "queue.Queue") -> None:
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # очередь внутрипроцессная: запись уходит как есть, без форматирования в вызывающем потоке
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1   # поток логов не успевает — теряем строку, но не блокируем loop
+
 logger = logging.getLogger("taskbot")
-logger.setLevel(logging.INFO)
+logger.setLevel(LOG_LEVEL)
+_log_formatter = JsonLogFormatter() if LOG_FORMAT == "json" else logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
 fh = RotatingFileHandler(LOGS_DIR / "bot.log", maxBytes=2_000_000, backupCount=3, encoding="utf-8")
-fh.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
-logger.addHandler(fh)
+fh.setFormatter(_log_formatter)
 ch = logging.StreamHandler()
-ch.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
-logger.addHandler(ch)
+ch.setFormatter(_log_formatter)
+log_queue = LogQueueHandler(queue.Queue(LOG_QUEUE_MAX))
+logger.addHandler(log_queue)
+log_listener = QueueListener(log_queue.queue, fh, ch, respect_handler_level=True)
+log_listener.start()
+# хвост очереди дописывается при выходе процесса: поток-демон ещё жив, пока работают atexit-хуки
+atexit.register(log_listener.stop)
 
-# Токен берём из окружения
+def log_event(event: str, level: int = logging.INFO, sample: float = 1.0, **fields: Any) -> None:
+    # sample < 1 — пишем только такую долю событий (для строк, которые идут на каждый тик)
+    if not logger.isEnabledFor(level) or (sample < 1.0 and random.random() >= sample):
+        return
+    logger.log(level, "%s %s", event, EventFields(fields), extra={"event": event, "fields": fields})
+
+# Токен берём из окружения; проверяем в make_app, чтобы модуль импортировался и без него (bench.py)
 TOKEN = os.getenv("TG_BOT_TOKEN")
-if not TOKEN:
-    raise RuntimeError("Не задан TG_BOT_TOKEN в окружении.")
+# Свой адрес Bot API (локальный telegram-bot-api или фейковый сервер bench.py), вида http://host:port/bot
+TG_API_URL = os.getenv("TG_API_URL")
 
 # интервалы напоминаний
 REM_OPTIONS = {
@@ -47,178 +133,1856 @@ REM_OPTIONS = {
     "6h": 6 * 60 * 60,
 }
 
+# ---------- МЕТРИКИ ----------
+# Простой реестр в формате Prometheus: счётчики, гистограммы и гейджи-колбэки.
+# Всё обновляется и рендерится только из event loop, поэтому без блокировок: код из пула потоков
+# копит свои цифры у себя, а в реестр они попадают гейджами или через loop. Отдаётся на /metrics (вебхук)
+# или периодически пишется в DATA_DIR/metrics.prom (METRICS_DUMP_INTERVAL, polling).
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+LAG_BUCKETS = (0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "0"))
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, n: float = 1.0) -> None:
+        self.value += n
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metrics:
+    def __init__(self) -> None:
+        self._help: Dict[str, Tuple[str, str]] = {}   # name -> (type, help)
+        self._counters: Dict[Tuple[str, Tuple], Counter] = {}
+        self._hists: Dict[Tuple[str, Tuple], Histogram] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def counter(self, name: str, help: str = "", **labels: str) -> Counter:
+        key = (name, tuple(sorted(labels.items())))
+        c = self._counters.get(key)
+        if c is None:
+            self._help.setdefault(name, ("counter", help))
+            c = self._counters[key] = Counter()
+        return c
+
+    def histogram(self, name: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS, help: str = "", **labels: str) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        h = self._hists.get(key)
+        if h is None:
+            self._help.setdefault(name, ("histogram", help))
+            h = self._hists[key] = Histogram(buckets)
+        return h
+
+    def gauge(self, name: str, fn: Callable[[], float], help: str = "", kind: str = "gauge") -> None:
+        # kind="counter" — для монотонных счётчиков, которые уже живут в других объектах
+        self._help[name] = (kind, help)
+        self._gauges[name] = fn
+
+    def render(self) -> str:
+        series: Dict[str, List[str]] = {}
+        for (name, labels), c in self._counters.items():
+            series.setdefault(name, []).append(f"{name}{_labels(labels)} {c.value:g}")
+        for (name, labels), h in self._hists.items():
+            rows = series.setdefault(name, [])
+            acc = 0
+            for bound, n in zip(h.buckets, h.counts):
+                acc += n
+                le = _labels(labels, 'le="%g"' % bound)
+                rows.append(f"{name}_bucket{le} {acc}")
+            le = _labels(labels, 'le="+Inf"')
+            rows.append(f"{name}_bucket{le} {h.count}")
+            rows.append(f"{name}_sum{_labels(labels)} {h.sum:.6f}")
+            rows.append(f"{name}_count{_labels(labels)} {h.count}")
+        for name, fn in self._gauges.items():
+            try:
+                series.setdefault(name, []).append(f"{name} {float(fn()):g}")
+            except Exception as e:
+                logger.warning(f"METRICS: gauge {name} failed err={e}")
+        out = []
+        for name in sorted(series):
+            kind, help = self._help.get(name, ("untyped", ""))
+            if help:
+                out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(series[name])
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
 # ---------- УТИЛЫ ХРАНИЛИЩА ----------
-def _user_file(user_id: int) -> Path:
-    return DATA_DIR / f"{user_id}.json"
+def _empty_doc() -> Dict[str, Any]:
+    return _ensure_defaults({})
 
 def _ensure_defaults(data: Dict[str, Any]) -> Dict[str, Any]:
     data.setdefault("seq", 0)
     data.setdefault("tasks", {})           # id -> {id, name, progress(0..100), reminder_interval}
     data.setdefault("stats", {"closed": 0})
+    data.setdefault("ver", 0)              # растёт при каждом сохранении, для проверки устаревших записей
+    # отсортированный список id задач: страницы списка режутся из него без сортировки
+    order = data.get("order")
+    if order is None or len(order) != len(data["tasks"]):
+        data["order"] = sorted(int(sid) for sid in data["tasks"])
     return data
 
-def load_tasks(user_id: int) -> Dict[str, Any]:
-    fp = _user_file(user_id)
-    if fp.exists():
-        try:
-            return _ensure_defaults(json.loads(fp.read_text(encoding="utf-8")))
-        except Exception:
-            return {"seq": 0, "tasks": {}, "stats": {"closed": 0}}
-    return {"seq": 0, "tasks": {}, "stats": {"closed": 0}}
+def add_task(data: Dict[str, Any], name: str) -> int:
+    data["seq"] += 1
+    tid = data["seq"]
+    data["tasks"][str(tid)] = {"id": tid, "name": name, "progress": 0, "reminder_interval": None}
+    data["order"].append(tid)  # seq только растёт, порядок не ломается
+    return tid
+
+def remove_task(data: Dict[str, Any], tid: int) -> Optional[Dict[str, Any]]:
+    t = data["tasks"].pop(str(tid), None)
+    order = data["order"]
+    i = bisect.bisect_left(order, tid)
+    if i < len(order) and order[i] == tid:
+        del order[i]
+    return t
+
+# ---------- ФОРМАТ ДОКУМЕНТА ----------
+# На диске документ хранится компактно (формат 2): без отступов и без повторяющихся ключей,
+# задачи — позиционные строки [id, name, progress, reminder_interval] в порядке order.
+#   {"_f":2,"s":seq,"c":closed,"v":ver,"t":[[1,"Имя",30,300],...]}
+# Старые файлы (indent=2, словарь задач) читаются как раньше. orjson — если установлен.
+DOC_FORMAT = 2
+
+def _dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _loads(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def encode_doc(data: Dict[str, Any]) -> bytes:
+    tasks = data["tasks"]
+    rows = []
+    for tid in data["order"]:
+        t = tasks[str(tid)]
+        rows.append([tid, t["name"], int(t.get("progress", 0)), t.get("reminder_interval")])
+    return _dumps({
+        "_f": DOC_FORMAT,
+        "s": data["seq"],
+        "c": int(data["stats"].get("closed", 0)),
+        "v": data.get("ver", 0),
+        "t": rows,
+    })
+
+def decode_doc(raw: bytes) -> Dict[str, Any]:
+    obj = _loads(raw)
+    if obj.get("_f") != DOC_FORMAT:
+        return _ensure_defaults(obj)  # старый развёрнутый формат
+    tasks = {}
+    for tid, name, progress, interval in obj["t"]:
+        tasks[str(tid)] = {"id": tid, "name": name, "progress": progress, "reminder_interval": interval}
+    return _ensure_defaults({
+        "seq": obj["s"],
+        "tasks": tasks,
+        "stats": {"closed": obj["c"]},
+        "ver": obj["v"],
+        "order": [row[0] for row in obj["t"]],
+    })
+
+# ---------- БЭКЕНДЫ ХРАНИЛИЩА ----------
+# STORAGE=json   — по файлу <user_id>.json на пользователя (как раньше)
+# STORAGE=sqlite — одна база tasks.db (WAL), задача = строка с ключом (user_id, task_id)
+# STORAGE=journal — снимки как у json + общий журнал изменений (см. «ЖУРНАЛ ИЗМЕНЕНИЙ»);
+#                   переход с json не требует миграции: файлы пользователей и есть снимки
+STORAGE = os.getenv("STORAGE", "json").lower()
+
+class Storage:
+    # Методы вызываются из пула потоков (см. «ВВОД-ВЫВОД»), кроме reminder_set/reminder_del:
+    # те дёргаются прямо из event loop и только копят изменения индекса до flush().
+    def __init__(self) -> None:
+        self.bytes_written = 0   # сколько байт ушло в хранилище (для bench.py и метрик)
+        self._rem_lock = threading.Lock()
+        self._rem_pending: Dict[Tuple[int, int], Optional[Tuple[int, float]]] = {}
+
+    def load(self, user_id: int) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def save(self, user_id: int, data: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def user_ids(self) -> Iterator[int]:
+        raise NotImplementedError
+
+    # индекс напоминаний: (user_id, tid) -> (interval, anchor); None — индекс ещё не построен.
+    # anchor — любой срок в фазе напоминания: срабатывания идут в anchor + k*interval, поэтому
+    # индекс меняется только при постановке, отмене и сдвиге фазы, а не на каждом срабатывании
+    def reminders_load(self) -> Optional[List[Tuple[int, int, int, float]]]:
+        self.flush()
+        return self._load_reminders()
+
+    def reminder_set(self, user_id: int, tid: int, interval: int, next_due: float) -> None:
+        with self._rem_lock:
+            self._rem_pending[(user_id, tid)] = (interval, next_due)
+
+    def reminder_del(self, user_id: int, tid: int) -> None:
+        with self._rem_lock:
+            self._rem_pending[(user_id, tid)] = None
+
+    def flush(self) -> None:
+        with self._rem_lock:
+            ops, self._rem_pending = self._rem_pending, {}
+        if ops:
+            self._apply_reminders(ops)
+
+    def _load_reminders(self) -> Optional[List[Tuple[int, int, int, float]]]:
+        raise NotImplementedError
+
+    def _apply_reminders(self, ops: Dict[Tuple[int, int], Optional[Tuple[int, float]]]) -> None:
+        raise NotImplementedError
+
+    def take_commit_seconds(self) -> List[float]:
+        # длительности групповых fsync с прошлого вызова; в метрики их кладёт event loop
+        return []
+
+    def close(self) -> None:
+        self.flush()
+
+class JsonStorage(Storage):
+    def __init__(self, root: Path) -> None:
+        super().__init__()
+        self.root = root
+        # индекс напоминаний: снимок reminders.idx + журнал reminders.log, куда flush только дописывает;
+        # снимок переписывается, когда журнал перерастает сам индекс
+        self.rem_file = root / "reminders.idx"
+        self.rem_log = root / "reminders.log"
+        self._rem: Optional[Dict[str, List[float]]] = None
+        self._rem_log_lines = 0
+
+    def _user_file(self, user_id: int) -> Path:
+        return self.root / f"{user_id}.json"
+
+    def load(self, user_id: int) -> Dict[str, Any]:
+        fp = self._user_file(user_id)
+        if fp.exists():
+            try:
+                return decode_doc(fp.read_bytes())
+            except Exception:
+                return _empty_doc()
+        return _empty_doc()
+
+    def save(self, user_id: int, data: Dict[str, Any]) -> None:
+        fp = self._user_file(user_id)
+        tmp = fp.with_suffix(".json.tmp")
+        raw = encode_doc(data)
+        tmp.write_bytes(raw)
+        tmp.replace(fp)
+        self.bytes_written += len(raw)
+
+    def user_ids(self) -> Iterator[int]:
+        for fp in self.root.glob("*.json"):
+            try:
+                yield int(fp.stem)
+            except ValueError:
+                continue
+
+    def _rem_index(self) -> Dict[str, List[float]]:
+        if self._rem is None:
+            try:
+                self._rem = _loads(self.rem_file.read_bytes())
+            except Exception:
+                self._rem = {}
+            try:
+                lines = self.rem_log.read_bytes().splitlines()
+            except FileNotFoundError:
+                lines = []
+            torn = False
+            for line in lines:
+                try:
+                    key, *entry = _loads(line)
+                except Exception:
+                    torn = True   # оборванная последняя строка
+                    break
+                if entry:
+                    self._rem[key] = entry
+                else:
+                    self._rem.pop(key, None)
+            self._rem_log_lines = len(lines)
+            if torn:
+                self._write_rem_snapshot()   # дописывать за обрывком нельзя — начинаем журнал заново
+        return self._rem
+
+    def _write_rem_snapshot(self) -> None:
+        tmp = self.rem_file.with_suffix(".tmp")
+        raw = _dumps(self._rem_index())
+        tmp.write_bytes(raw)
+        tmp.replace(self.rem_file)
+        self.rem_log.write_bytes(b"")
+        self._rem_log_lines = 0
+        self.bytes_written += len(raw)
+
+    def _load_reminders(self) -> Optional[List[Tuple[int, int, int, float]]]:
+        if not self.rem_file.exists():
+            # индекса ещё нет: вызывающий построит его через reminder_set
+            self._rem = {}
+            self._write_rem_snapshot()
+            return None
+        out = []
+        for key, (interval, next_due) in self._rem_index().items():
+            user_id, tid = key.split(":")
+            out.append((int(user_id), int(tid), int(interval), float(next_due)))
+        return out
+
+    def _apply_reminders(self, ops: Dict[Tuple[int, int], Optional[Tuple[int, float]]]) -> None:
+        index = self._rem_index()
+        lines = []
+        for (user_id, tid), entry in ops.items():
+            key = f"{user_id}:{tid}"
+            if entry is None:
+                index.pop(key, None)
+                lines.append(_dumps([key]))
+            else:
+                index[key] = [entry[0], entry[1]]
+                lines.append(_dumps([key, entry[0], entry[1]]))
+        if self._rem_log_lines + len(lines) > max(1024, len(index)):
+            self._write_rem_snapshot()
+            return
+        raw = b"\n".join(lines) + b"\n"
+        with open(self.rem_log, "ab") as f:
+            f.write(raw)
+        self._rem_log_lines += len(lines)
+        self.bytes_written += len(raw)
+
+class SqliteStorage(Storage):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            seq     INTEGER NOT NULL DEFAULT 0,
+            closed  INTEGER NOT NULL DEFAULT 0,
+            ver     INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS tasks (
+            user_id           INTEGER NOT NULL,
+            task_id           INTEGER NOT NULL,
+            name              TEXT    NOT NULL,
+            progress          INTEGER NOT NULL DEFAULT 0,
+            reminder_interval INTEGER,
+            PRIMARY KEY (user_id, task_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS reminders (
+            user_id  INTEGER NOT NULL,
+            task_id  INTEGER NOT NULL,
+            interval INTEGER NOT NULL,
+            next_due REAL    NOT NULL,
+            PRIMARY KEY (user_id, task_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path: Path) -> None:
+        super().__init__()
+        self.path = path
+        # одно соединение на все потоки пула, доступ сериализуем своим локом
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        if "ver" not in {row[1] for row in self.db.execute("PRAGMA table_info(users)")}:
+            self.db.execute("ALTER TABLE users ADD COLUMN ver INTEGER NOT NULL DEFAULT 0")
+
+    def load(self, user_id: int) -> Dict[str, Any]:
+        with self.lock:
+            return self._load(user_id)
+
+    def _load(self, user_id: int) -> Dict[str, Any]:
+        data = _empty_doc()
+        row = self.db.execute("SELECT seq, closed, ver FROM users WHERE user_id=?", (user_id,)).fetchone()
+        if row:
+            data["seq"], data["stats"]["closed"], data["ver"] = row
+        for tid, name, progress, interval in self.db.execute(
+            "SELECT task_id, name, progress, reminder_interval FROM tasks WHERE user_id=?", (user_id,)
+        ):
+            data["tasks"][str(tid)] = {"id": tid, "name": name, "progress": progress, "reminder_interval": interval}
+        data["order"] = sorted(int(tid) for tid in data["tasks"])
+        return data
+
+    def save(self, user_id: int, data: Dict[str, Any]) -> None:
+        with self.lock:
+            self._save(user_id, data)
+
+    def _save(self, user_id: int, data: Dict[str, Any]) -> None:
+        # пишем только изменившиеся строки: +10% = один UPDATE, а не перезапись всего документа
+        stored = {
+            tid: (name, progress, interval)
+            for tid, name, progress, interval in self.db.execute(
+                "SELECT task_id, name, progress, reminder_interval FROM tasks WHERE user_id=?", (user_id,)
+            )
+        }
+        current = {
+            int(sid): (t["name"], int(t.get("progress", 0)), t.get("reminder_interval"))
+            for sid, t in data["tasks"].items()
+        }
+        upserts = [(user_id, tid, *row) for tid, row in current.items() if stored.get(tid) != row]
+        deletes = [(user_id, tid) for tid in stored.keys() - current.keys()]
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute(
+                "INSERT INTO users(user_id, seq, closed, ver) VALUES(?,?,?,?) "
+                "ON CONFLICT(user_id) DO UPDATE SET seq=excluded.seq, closed=excluded.closed, ver=excluded.ver",
+                (user_id, int(data["seq"]), int(data["stats"].get("closed", 0)), int(data.get("ver", 0))),
+            )
+            if upserts:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO tasks(user_id, task_id, name, progress, reminder_interval) "
+                    "VALUES(?,?,?,?,?)", upserts,
+                )
+            if deletes:
+                self.db.executemany("DELETE FROM tasks WHERE user_id=? AND task_id=?", deletes)
+        # оценка полезной нагрузки строк: реальные страницы WAL sqlite не отдаёт
+        self.bytes_written += 24 + sum(24 + len(row[2].encode("utf-8")) for row in upserts) + 16 * len(deletes)
+
+    def user_ids(self) -> Iterator[int]:
+        with self.lock:
+            rows = self.db.execute("SELECT user_id FROM users").fetchall()
+        for (user_id,) in rows:
+            yield user_id
+
+    def _load_reminders(self) -> Optional[List[Tuple[int, int, int, float]]]:
+        with self.lock:
+            if not self.db.execute("SELECT 1 FROM meta WHERE key='reminder_index'").fetchone():
+                self.db.execute("INSERT INTO meta(key, value) VALUES('reminder_index', '1')")
+                return None
+            return self.db.execute("SELECT user_id, task_id, interval, next_due FROM reminders").fetchall()
+
+    def _apply_reminders(self, ops: Dict[Tuple[int, int], Optional[Tuple[int, float]]]) -> None:
+        upserts = [(u, t, e[0], e[1]) for (u, t), e in ops.items() if e is not None]
+        deletes = [(u, t) for (u, t), e in ops.items() if e is None]
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            if upserts:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO reminders(user_id, task_id, interval, next_due) VALUES(?,?,?,?)",
+                    upserts,
+                )
+            if deletes:
+                self.db.executemany("DELETE FROM reminders WHERE user_id=? AND task_id=?", deletes)
+        self.bytes_written += 32 * len(upserts) + 16 * len(deletes)
+
+    def close(self) -> None:
+        self.flush()
+        with self.lock:
+            self.db.close()
+
+def migrate_json_to_sqlite(src: JsonStorage, dst: SqliteStorage) -> int:
+    # одноразовый перенос: перенесённые файлы переименовываем в *.json.migrated
+    moved = 0
+    for user_id in list(src.user_ids()):
+        dst.save(user_id, src.load(user_id))
+        fp = src._user_file(user_id)
+        fp.replace(fp.with_suffix(".json.migrated"))
+        moved += 1
+    return moved
+
+# ---------- ЖУРНАЛ ИЗМЕНЕНИЙ (STORAGE=journal) ----------
+# Вместо перезаписи документа целиком каждое изменение — одна короткая строка в общем журнале:
+#   {"op":"progress","id":tid,"p":40,"u":user_id,"s":seq,"c":closed,"v":ver}
+# op: create | progress | rename | reminder | close | delete. Записи копятся в памяти и на flush()
+# уходят в journal.log одним write + одним fsync на всю пачку (group commit).
+# Снимки — обычные <user_id>.json (как у STORAGE=json): компактор периодически складывает в них
+# накопленное состояние и обнуляет журнал. При старте хвост журнала проигрывается поверх снимков.
+# Поле v (ver документа) делает проигрывание идемпотентным: записи не новее снимка пропускаются.
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+JOURNAL_COMPACT_INTERVAL = float(os.getenv("JOURNAL_COMPACT_INTERVAL", "300"))
+
+class JournalStorage(Storage):
+    def __init__(self, root: Path) -> None:
+        super().__init__()
+        self.snap = JsonStorage(root)          # снимки и индекс напоминаний
+        self.path = root / "journal.log"
+        self.old_path = root / "journal.old"   # журнал, который сейчас складывается в снимки
+        self._lock = threading.Lock()          # _state, _folding, _buf
+        self._commit_lock = threading.Lock()   # один писатель журнала, порядок записей сохраняется
+        self._compact_lock = threading.Lock()
+        # документы, изменённые после последнего снимка, — последнее записанное в журнал состояние
+        self._state: Dict[int, Dict[str, Any]] = {}
+        self._folding: Dict[int, Dict[str, Any]] = {}
+        self._buf: List[bytes] = []
+        # счётчики для метрик: пишутся из пула потоков, реестр читает их гейджами
+        self.records = 0
+        self.commits = 0
+        self.compactions = 0
+        self._commit_seconds: List[float] = []
+        self.compacted_at = time.monotonic()
+        self._recover()
+        self._fh = open(self.path, "ab")
+
+    # --- чтение ---
+    def _current(self, user_id: int) -> Dict[str, Any]:
+        with self._lock:
+            doc = self._state.get(user_id) or self._folding.get(user_id)
+        return doc if doc is not None else self.snap.load(user_id)
+
+    def load(self, user_id: int) -> Dict[str, Any]:
+        with self._lock:
+            doc = self._state.get(user_id) or self._folding.get(user_id)
+            if doc is not None:
+                return copy.deepcopy(doc)
+        return self.snap.load(user_id)
+
+    def user_ids(self) -> Iterator[int]:
+        with self._lock:
+            pending = set(self._state) | set(self._folding)
+        for user_id in self.snap.user_ids():
+            pending.discard(user_id)
+            yield user_id
+        yield from pending
+
+    # --- запись ---
+    def save(self, user_id: int, data: Dict[str, Any]) -> None:
+        # data — снимок из DocCache.take_dirty, дальше его никто не меняет: храним без копии
+        records = self._diff(user_id, self._current(user_id), data)
+        lines = [_dumps(rec) + b"\n" for rec in records]
+        with self._lock:
+            self._state[user_id] = data
+            self._buf.extend(lines)
+            self.records += len(lines)
+
+    @staticmethod
+    def _diff(user_id: int, prev: Dict[str, Any], doc: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # каждая запись несёт счётчики документа (s — seq, c — stats.closed) целиком:
+        # задача, созданная и закрытая между двумя сбросами, в журнал не попадает, а счётчики — да
+        head = {"u": user_id, "s": doc["seq"], "c": int(doc["stats"].get("closed", 0)), "v": doc.get("ver", 0)}
+        old, new = prev["tasks"], doc["tasks"]
+        records: List[Dict[str, Any]] = []
+        for sid, t in new.items():
+            tid = t["id"]
+            was = old.get(sid)
+            if was is None:
+                records.append({"op": "create", "id": tid, "n": t["name"], **head})
+                was = {"name": t["name"], "progress": 0, "reminder_interval": None}
+            if t["name"] != was["name"]:
+                records.append({"op": "rename", "id": tid, "n": t["name"], **head})
+            if t.get("progress", 0) != was.get("progress", 0):
+                records.append({"op": "progress", "id": tid, "p": t.get("progress", 0), **head})
+            if t.get("reminder_interval") != was.get("reminder_interval"):
+                records.append({"op": "reminder", "id": tid, "r": t.get("reminder_interval"), **head})
+        # исчезнувшие задачи: сколько выросло stats.closed — столько из них закрыто, остальные удалены
+        closed = head["c"] - int(prev["stats"].get("closed", 0))
+        for sid in sorted(set(old) - set(new), key=int):
+            op = "delete"
+            if closed > 0:
+                op, closed = "close", closed - 1
+            records.append({"op": op, "id": int(sid), **head})
+        if not records and (head["s"] != prev["seq"] or closed > 0):
+            records.append({"op": "close", "id": None, **head})
+        return records
+
+    @staticmethod
+    def _apply(doc: Dict[str, Any], rec: Dict[str, Any]) -> None:
+        op, tid = rec["op"], rec["id"]
+        t = doc["tasks"].get(str(tid))
+        if op == "create":
+            if t is None:
+                doc["tasks"][str(tid)] = {"id": tid, "name": rec["n"], "progress": 0, "reminder_interval": None}
+                bisect.insort(doc["order"], tid)
+        elif op in ("close", "delete"):
+            if tid is not None:
+                remove_task(doc, tid)
+        elif t is not None:
+            if op == "progress":
+                t["progress"] = rec["p"]
+            elif op == "rename":
+                t["name"] = rec["n"]
+            elif op == "reminder":
+                t["reminder_interval"] = rec["r"]
+        doc["seq"] = max(doc["seq"], rec["s"])
+        doc["stats"]["closed"] = rec["c"]
+        doc["ver"] = max(doc.get("ver", 0), rec["v"])
+
+    def flush(self) -> None:
+        self._commit()
+        super().flush()
+
+    def _commit(self) -> None:
+        # group commit: всё, что накопилось к этому моменту, — одним write и одним fsync
+        with self._commit_lock:
+            with self._lock:
+                lines, self._buf = self._buf, []
+            if not lines:
+                return
+            started = time.perf_counter()
+            raw = b"".join(lines)
+            self._fh.write(raw)
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self.bytes_written += len(raw)
+            with self._lock:
+                self.commits += 1
+                self._commit_seconds.append(time.perf_counter() - started)
+
+    def take_commit_seconds(self) -> List[float]:
+        with self._lock:
+            taken, self._commit_seconds = self._commit_seconds, []
+        return taken
+
+    # --- индекс напоминаний живёт в снимках ---
+    def _load_reminders(self) -> Optional[List[Tuple[int, int, int, float]]]:
+        return self.snap._load_reminders()
+
+    def _apply_reminders(self, ops: Dict[Tuple[int, int], Optional[Tuple[int, float]]]) -> None:
+        before = self.snap.bytes_written
+        self.snap._apply_reminders(ops)
+        self.bytes_written += self.snap.bytes_written - before
+
+    # --- компактор ---
+    def needs_compaction(self) -> bool:
+        if not self._state and not self.old_path.exists():
+            return False
+        size = self.path.stat().st_size if self.path.exists() else 0
+        return size >= JOURNAL_COMPACT_BYTES or time.monotonic() - self.compacted_at >= JOURNAL_COMPACT_INTERVAL
+
+    def compact(self) -> int:
+        # 1) журнал переименовывается в journal.old, новые записи идут в свежий journal.log;
+        # 2) накопленные документы пишутся снимками с fsync; 3) journal.old удаляется.
+        # Если шаг 2 упал, journal.old и _folding остаются — следующий вызов продолжит с него.
+        with self._compact_lock:
+            if not self.old_path.exists():
+                with self._commit_lock:
+                    with self._lock:
+                        lines, self._buf = self._buf, []
+                        self._folding, self._state = self._state, {}
+                    if lines:
+                        # незакоммиченный хвост остаётся в ротируемом журнале вместе со своими документами
+                        raw = b"".join(lines)
+                        self._fh.write(raw)
+                        self._fh.flush()
+                        os.fsync(self._fh.fileno())
+                        self.bytes_written += len(raw)
+                    self._fh.close()
+                    self.path.replace(self.old_path)
+                    self._fh = open(self.path, "ab")
+            folded = len(self._folding)
+            self._write_snapshots(self._folding)
+            self.old_path.unlink()
+            with self._lock:
+                self._folding = {}
+            self.compacted_at = time.monotonic()
+            self.compactions += 1
+        return folded
+
+    def _write_snapshots(self, docs: Dict[int, Dict[str, Any]]) -> None:
+        for user_id, doc in docs.items():
+            fp = self.snap._user_file(user_id)
+            tmp = fp.with_suffix(".json.tmp")
+            raw = encode_doc(doc)
+            with open(tmp, "wb") as f:
+                f.write(raw)
+                f.flush()
+                os.fsync(f.fileno())
+            tmp.replace(fp)
+            self.bytes_written += len(raw)
+        if docs:
+            try:
+                fd = os.open(self.snap.root, os.O_RDONLY)
+            except OSError:
+                return  # платформа без fsync каталогов
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    # --- восстановление ---
+    def _recover(self) -> None:
+        # старт после падения: journal.old (если компактор не успел) и journal.log — поверх снимков
+        docs: Dict[int, Dict[str, Any]] = {}
+        base_ver: Dict[int, int] = {}
+        replayed = skipped = 0
+        for path in (self.old_path, self.path):
+            if not path.exists():
+                continue
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        rec = _loads(line)
+                    except ValueError:
+                        # оборванная последняя строка: запись не успела закоммититься
+                        logger.warning(f"JOURNAL: torn record in {path.name}, tail ignored")
+                        break
+                    user_id = rec["u"]
+                    if user_id not in docs:
+                        docs[user_id] = self.snap.load(user_id)
+                        base_ver[user_id] = docs[user_id].get("ver", 0)
+                    if rec["v"] <= base_ver[user_id]:
+                        skipped += 1   # уже в снимке
+                        continue
+                    self._apply(docs[user_id], rec)
+                    replayed += 1
+        if docs:
+            self._write_snapshots(docs)
+            logger.info(f"JOURNAL: recovered users={len(docs)} replayed={replayed} skipped={skipped}")
+        self.old_path.unlink(missing_ok=True)
+        if self.path.exists():
+            self.path.unlink()
+
+    def close(self) -> None:
+        self.flush()
+        self.compact()
+        self._fh.close()
+
+def make_storage(root: Path = DATA_DIR) -> Storage:
+    root.mkdir(parents=True, exist_ok=True)
+    if STORAGE == "sqlite":
+        db = SqliteStorage(root / "tasks.db")
+        moved = migrate_json_to_sqlite(JsonStorage(root), db)
+        if moved:
+            logger.info(f"STORAGE: migrated {moved} json docs to sqlite")
+        return db
+    if STORAGE == "journal":
+        return JournalStorage(root)
+    if STORAGE != "json":
+        raise RuntimeError(f"Неизвестный STORAGE={STORAGE!r} (json | sqlite | journal)")
+    return JsonStorage(root)
+
+storage = make_storage()
+
+# ---------- КЭШ ДОКУМЕНТОВ (write-behind) ----------
+# Документы живут в памяти (LRU), save_tasks только помечает их грязными.
+# На диск пишем пачкой: по таймеру, при переполнении грязных и при остановке.
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "1000"))
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "2"))
+FLUSH_MAX_DIRTY = int(os.getenv("FLUSH_MAX_DIRTY", "200"))
+
+class DocCache:
+    def __init__(self, capacity: int, max_dirty: int) -> None:
+        self.capacity = max(1, capacity)
+        self.max_dirty = max(1, max_dirty)
+        self._docs: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._dirty: Set[int] = set()
+        self._pending: Dict[int, Dict[str, Any]] = {}    # вытеснены грязными, ждут записи
+        self._inflight: Dict[int, Dict[str, Any]] = {}   # сейчас пишутся в пуле
+
+    def get(self, user_id: int):
+        doc = self._docs.get(user_id)
+        if doc is not None:
+            self._docs.move_to_end(user_id)
+            return doc
+        # пока документ не дописан на диск, читать его с диска нельзя
+        doc = self._pending.pop(user_id, None)
+        if doc is not None:
+            self.put(user_id, doc)
+            self._dirty.add(user_id)
+            return doc
+        doc = self._inflight.get(user_id)
+        if doc is not None:
+            self.put(user_id, doc)
+        return doc
+
+    def put(self, user_id: int, doc: Dict[str, Any]) -> None:
+        self._docs[user_id] = doc
+        self._docs.move_to_end(user_id)
+        # вытесняем самых старых; грязные откладываем до ближайшего flush
+        while len(self._docs) > self.capacity:
+            old_id, old_doc = self._docs.popitem(last=False)
+            if old_id in self._dirty:
+                self._dirty.discard(old_id)
+                self._pending[old_id] = old_doc
+
+    def mark_dirty(self, user_id: int, doc: Dict[str, Any]) -> bool:
+        # True — грязных набралось достаточно, пора сбрасывать
+        self.put(user_id, doc)
+        self._dirty.add(user_id)
+        return len(self._dirty) + len(self._pending) >= self.max_dirty
+
+    def take_dirty(self) -> List[Tuple[int, Dict[str, Any]]]:
+        # снимки делаем в event loop: пул пишет копии, а живые документы можно менять дальше
+        docs = {user_id: self._docs[user_id] for user_id in self._dirty}
+        docs.update(self._pending)
+        batch = [(user_id, copy.deepcopy(doc)) for user_id, doc in docs.items()]
+        self._inflight.update(docs)
+        self._dirty, self._pending = set(), {}
+        return batch
+
+    def written(self, user_ids: List[int]) -> None:
+        for user_id in user_ids:
+            self._inflight.pop(user_id, None)
+
+    def failed(self, user_ids: List[int]) -> None:
+        # запись не удалась — документы снова грязные, их повторит следующий flush
+        for user_id in user_ids:
+            doc = self._inflight.pop(user_id, None)
+            if user_id in self._docs:
+                self._dirty.add(user_id)
+            elif doc is not None:
+                self._pending[user_id] = doc
+
+_cache = DocCache(CACHE_SIZE, FLUSH_MAX_DIRTY)
+
+# ---------- ВВОД-ВЫВОД ----------
+# Блокирующие чтения/записи хранилища идут в ограниченный пул потоков,
+# event loop их только ждёт.
+IO_WORKERS = int(os.getenv("IO_WORKERS", "4"))
+
+_io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="storage")
+_flush_lock = asyncio.Lock()
+
+async def run_io(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_io_pool, fn, *args)
+
+async def load_tasks(user_id: int) -> Dict[str, Any]:
+    data = _cache.get(user_id)
+    if data is None:
+        metrics.counter("taskbot_cache_total", "Обращения к кэшу документов", result="miss").inc()
+        started = time.perf_counter()
+        loaded = await run_io(storage.load, user_id)
+        metrics.histogram("taskbot_storage_load_seconds", help="Чтение документа из хранилища").observe(
+            time.perf_counter() - started)
+        # пока ждали пул, документ мог появиться в кэше
+        data = _cache.get(user_id)
+        if data is None:
+            data = loaded
+            _cache.put(user_id, data)
+    else:
+        metrics.counter("taskbot_cache_total", "Обращения к кэшу документов", result="hit").inc()
+    return data
+
+class StaleWriteError(RuntimeError):
+    pass
 
 def save_tasks(user_id: int, data: Dict[str, Any]) -> None:
     data = _ensure_defaults(data)
-    fp = _user_file(user_id)
-    tmp = fp.with_suffix(".json.tmp")
-    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-    tmp.replace(fp)
+    # оптимистичная проверка: если в кэше уже другая, более новая копия — запись устарела
+    current = _cache.get(user_id)
+    if current is not None and current is not data and current.get("ver", 0) != data["ver"]:
+        raise StaleWriteError(f"user={user_id} ver={data['ver']} current={current.get('ver', 0)}")
+    data["ver"] += 1
+    if _cache.mark_dirty(user_id, data) and not _flush_lock.locked():
+        asyncio.get_running_loop().create_task(flush_tasks())
+
+def _write_batch(batch: List[Tuple[int, Dict[str, Any]]]) -> List[Tuple[float, int]]:
+    # (секунды, байты) на каждый документ — в метрики их кладёт уже event loop
+    timings = []
+    for user_id, doc in batch:
+        started, written = time.perf_counter(), storage.bytes_written
+        storage.save(user_id, doc)
+        timings.append((time.perf_counter() - started, storage.bytes_written - written))
+    storage.flush()
+    return timings
+
+async def flush_tasks() -> None:
+    async with _flush_lock:
+        batch = _cache.take_dirty()
+        started = time.perf_counter()
+        try:
+            timings = await run_io(_write_batch, batch)
+        except BaseException:
+            _cache.failed([user_id for user_id, _ in batch])
+            raise
+        _cache.written([user_id for user_id, _ in batch])
+        metrics.histogram("taskbot_flush_seconds", help="Сброс грязных документов").observe(time.perf_counter() - started)
+        for seconds, size in timings:
+            metrics.histogram("taskbot_storage_save_seconds", help="Запись документа в хранилище").observe(seconds)
+            metrics.histogram("taskbot_doc_size_bytes", SIZE_BUCKETS, help="Размер записанного документа").observe(size)
+        for seconds in storage.take_commit_seconds():
+            metrics.histogram("taskbot_journal_commit_seconds", help="Запись и fsync пачки журнала").observe(seconds)
+    if batch:
+        log_event("CACHE: flush", docs=len(batch))
+
+async def flush_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await flush_tasks()
+
+async def journal_compact_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not storage.needs_compaction():
+        return
+    started = time.perf_counter()
+    folded = await run_io(storage.compact)
+    logger.info(f"JOURNAL: compacted docs={folded} in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+# ---------- ЗАДЕРЖКА EVENT LOOP ----------
+# Фоновая корутина спит LAG_INTERVAL и меряет, насколько позже просыпается:
+# это время, на которое кто-то блокировал loop (раньше — синхронный диск в хендлерах).
+LAG_INTERVAL = float(os.getenv("LAG_INTERVAL", "0.5"))
+LAG_WARN = float(os.getenv("LAG_WARN", "0.2"))
+
+class LoopLag:
+    def __init__(self) -> None:
+        self.last = 0.0
+        self.max = 0.0
+        self.avg = 0.0
+        self.samples = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.record(time.monotonic() - started - LAG_INTERVAL)
+
+    def record(self, lag: float) -> None:
+        lag = max(0.0, lag)
+        self.last = lag
+        self.max = max(self.max, lag)
+        self.samples += 1
+        self.avg += (lag - self.avg) / min(self.samples, 100)   # скользящее среднее ~100 замеров
+        if lag > LAG_WARN:
+            logger.warning(f"LOOP: lag={lag * 1000:.0f}ms")
+
+loop_lag = LoopLag()
+
+# ---------- СНИМОК СОСТОЯНИЯ ----------
+# Для деплоя без потерь: при остановке в DATA_DIR/state.json пишется то, что иначе живёт только
+# в памяти, — user_data разговоров (ждём название/новое имя, открытая страница списка; их держит
+# DictPersistence), несобранные сводки напоминаний и недоставленные сообщения очереди отправки.
+# Сроки напоминаний уже в индексе хранилища, он сбрасывается при остановке вместе с кэшем.
+# На старте снимок применяется и удаляется. Telegram копит апдейты, пока бот перезапускается:
+# они не выбрасываются, если не задан DROP_PENDING_UPDATES=1.
+STATE_FILE = DATA_DIR / "state.json"
+STATE_VERSION = 1
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"
+# просроченные за время простоя напоминания срабатывают не разом, а вразброс за столько секунд
+REM_RESTORE_SPREAD = float(os.getenv("REM_RESTORE_SPREAD", "60"))
+
+def load_state() -> Dict[str, Any]:
+    try:
+        state = _loads(STATE_FILE.read_bytes())
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"STATE: unreadable snapshot, ignored err={e}")
+        return {}
+    if not isinstance(state, dict) or state.get("version") != STATE_VERSION:
+        logger.warning("STATE: unknown snapshot version, ignored")
+        return {}
+    return state
+
+_state = load_state()
+
+def make_persistence() -> DictPersistence:
+    # только user_data и только в памяти: на диск её кладёт save_state при остановке
+    return DictPersistence(
+        store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+        user_data_json=_state.get("user_data") or "",
+    )
+
+def save_state(app: Application) -> Dict[str, int]:
+    state = {
+        "version": STATE_VERSION,
+        "saved_at": time.time(),
+        "user_data": app.persistence.user_data_json if app.persistence else "",
+        "digests": digests.snapshot(),
+        "outbox": [[chat_id, text, markup.to_dict() if markup else None, tag]
+                   for chat_id, text, markup, tag, *_ in outbox.leftover],
+    }
+    tmp = STATE_FILE.with_suffix(".tmp")
+    tmp.write_bytes(_dumps(state))
+    tmp.replace(STATE_FILE)
+    return {"digests": len(state["digests"]), "outbox": len(state["outbox"])}
+
+async def restore_state(app: Application) -> None:
+    if not _state:
+        return
+    for chat_id, text, markup, tag in _state.get("outbox", []):
+        outbox.submit(chat_id, text, InlineKeyboardMarkup.de_json(markup, app.bot) if markup else None, tag=tag)
+    digests.restore(_state.get("digests", {}), time.time())
+    await run_io(STATE_FILE.unlink, True)
+    logger.info(f"STATE: restored snapshot age={time.time() - _state.get('saved_at', time.time()):.0f}s "
+                f"outbox={len(_state.get('outbox', []))} digests={len(_state.get('digests', {}))}")
+    _state.clear()
+
+async def _on_startup(app: Application) -> None:
+    loop_lag.start()
+    outbox.start(app.bot)
+    await _restore_reminders(app)
+    await restore_state(app)
+    logger.info("BOOT: reminders restored")
+
+async def _on_stop(app: Application) -> None:
+    # к этому моменту app.stop() уже дообработал очередь апдейтов и хендлеры в работе
+    await outbox.stop()
+    loop_lag.stop()
+    logger.info(f"SHUTDOWN: outbox drained sent={outbox.sent} failed={outbox.failed} left={len(outbox.leftover)}")
+
+async def _on_shutdown(app: Application) -> None:
+    # app.shutdown() перед этим последний раз обновил persistence
+    saved = await run_io(save_state, app)
+    logger.info(f"SHUTDOWN: state saved digests={saved['digests']} outbox={saved['outbox']}")
+    await flush_tasks()
+    await run_io(storage.close)
+    _io_pool.shutdown(wait=True)
+    logger.info("SHUTDOWN: cache flushed")
+
+# ---------- БЛОКИРОВКИ ПОЛЬЗОВАТЕЛЕЙ ----------
+# Апдейты разных пользователей обрабатываются параллельно (concurrent_updates),
+# а апдейты одного пользователя — строго по очереди под его шардом блокировок.
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+USER_LOCK_SHARDS = int(os.getenv("USER_LOCK_SHARDS", "256"))
+STALE_RETRIES = 3
+
+_user_locks = [asyncio.Lock() for _ in range(USER_LOCK_SHARDS)]
+
+def user_lock(user_id: int) -> asyncio.Lock:
+    return _user_locks[user_id % USER_LOCK_SHARDS]
+
+def _action_label(update: Update) -> str:
+    # для колбэков — действие без аргументов: "2p5" / "t:+10:5" -> "+10", "ui:list:2" -> "list"
+    q = update.callback_query
+    if not q or not q.data:
+        return ""
+    return decode_cb(q.data)[0]
+
+def per_user(handler):
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        started = time.perf_counter()
+        try:
+            await _run_locked(handler, update, context)
+        finally:
+            metrics.histogram(
+                "taskbot_handler_seconds", help="Время обработки апдейта",
+                handler=name, action=_action_label(update),
+            ).observe(time.perf_counter() - started)
+    return wrapper
+
+async def _run_locked(handler, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if user is None:
+        await handler(update, context)
+        return
+    async with user_lock(user.id):
+        for attempt in range(1, STALE_RETRIES + 1):
+            try:
+                await handler(update, context)
+                return
+            except StaleWriteError as e:
+                if attempt == STALE_RETRIES:
+                    raise
+                logger.warning(f"LOCK: stale write, retry {attempt} {e}")
+
+# размеры кэшей разбора кнопок, клавиатур и карточек
+KB_CACHE = int(os.getenv("KB_CACHE", "4096"))
+CARD_CACHE = int(os.getenv("CARD_CACHE", "4096"))
+
+# ---------- CALLBACK DATA ----------
+# Кнопки кодируются компактно: версия формата, однобуквенный код действия и числовые аргументы
+# через точку: "2o15" — открыть задачу 15, "2l3" — третья страница списка. Кнопки старого вида
+# ("t:open:15", "ui:list:3") в уже отправленных сообщениях разбираются как раньше.
+CB_VERSION = "2"
+CB_CODES = {
+    "menu": "m", "new": "n", "list": "l", "noop": "_",
+    "open": "o", "+10": "p", "-10": "d", "reset": "z", "ren": "r", "del": "x", "close": "c",
+    "rem": "a", "rem5m": "A", "rem30m": "B", "rem1h": "C", "rem3h": "D", "rem6h": "E",
+    "remoff": "k", "remtest": "t",
+}
+_CB_ACTIONS = {code: action for action, code in CB_CODES.items()}
+
+def cb(action: str, *args: int) -> str:
+    return CB_VERSION + CB_CODES[action] + ".".join(str(a) for a in args)
+
+@functools.lru_cache(maxsize=KB_CACHE)
+def decode_cb(data: str) -> Tuple[str, Tuple[int, ...]]:
+    # ("", ()) — данные не разобрались
+    try:
+        if data[:1] == CB_VERSION:
+            rest = data[2:]
+            return _CB_ACTIONS[data[1]], tuple(int(a) for a in rest.split(".")) if rest else ()
+        return _decode_legacy_cb(data)
+    except (KeyError, IndexError, ValueError):
+        return "", ()
+
+def _decode_legacy_cb(data: str) -> Tuple[str, Tuple[int, ...]]:
+    if data == "noop":
+        return "noop", ()
+    parts = data.split(":")
+    if parts[0] == "ui" and len(parts) in (2, 3):
+        action, args = parts[1], tuple(int(a) for a in parts[2:])
+    elif parts[0] == "t" and len(parts) in (3, 4):
+        action, args = parts[1], (int(parts[-1]),)
+    else:
+        return "", ()
+    return (action, args) if action in CB_CODES else ("", ())
 
 # ---------- ВИЗУАЛ ПРОГРЕССА ----------
+# Всё, что рендерится на каждый клик, посчитано заранее или закэшировано:
+# полосок всего 101, клавиатуры неизменяемые и зависят только от tid.
 PALETTE = ["🟥","🟥","🟧","🟧","🟨","🟨","🟩","🟩","🟩","🟩"]
 EMPTY = "◻️"
+# список задач режется на страницы, чтобы не упираться в лимиты Telegram на текст и клавиатуру
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "10"))
+NAME_LIMIT = 48
+DEBUGREM_LIMIT = 50
 
-def progress_bar(percent: int) -> str:
-    pct = max(0, min(100, int(percent)))
+def _render_bar(pct: int) -> str:
     filled = round(pct / 10)  # 0..10 сегментов
     bar = "".join(PALETTE[i] for i in range(filled)) + (EMPTY * (10 - filled))
     return f"{bar} {pct}%"
 
-def task_line(t: Dict[str, Any]) -> str:
+_BARS = tuple(_render_bar(pct) for pct in range(101))
+
+REM_LABELS = {
+    REM_OPTIONS["5m"]: "5м",
+    REM_OPTIONS["30m"]: "30м",
+    REM_OPTIONS["1h"]: "1ч",
+    REM_OPTIONS["3h"]: "3ч",
+    REM_OPTIONS["6h"]: "6ч",
+}
+
+def progress_bar(percent: int) -> str:
+    return _BARS[max(0, min(100, int(percent)))]
+
+@functools.lru_cache(maxsize=CARD_CACHE)
+def _card_text(name: str, progress: int, interval: Optional[int]) -> str:
     rem = ""
-    interval = t.get("reminder_interval")
-    labels = {
-        REM_OPTIONS["5m"]: "5м",
-        REM_OPTIONS["30m"]: "30м",
-        REM_OPTIONS["1h"]: "1ч",
-        REM_OPTIONS["3h"]: "3ч",
-        REM_OPTIONS["6h"]: "6ч",
-    }
     if interval:
-        rem = f" • напоминание: {labels.get(int(interval), str(interval)+'с')}"
-    return f"{t['name']}\n{progress_bar(t.get('progress', 0))}{rem}"
+        rem = f" • напоминание: {REM_LABELS.get(int(interval), str(interval)+'с')}"
+    return f"{name}\n{progress_bar(progress)}{rem}"
+
+def task_line(t: Dict[str, Any]) -> str:
+    return _card_text(t["name"], int(t.get("progress", 0)), t.get("reminder_interval"))
 
+@functools.lru_cache(maxsize=None)
 def main_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ Задача", callback_data="ui:new")],
-        [InlineKeyboardButton("📋 Мои задачи", callback_data="ui:list")]
+        [InlineKeyboardButton("➕ Задача", callback_data=cb("new"))],
+        [InlineKeyboardButton("📋 Мои задачи", callback_data=cb("list"))]
     ])
 
+@functools.lru_cache(maxsize=None)
+def back_to_menu_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Меню", callback_data=cb("menu"))]])
+
+@functools.lru_cache(maxsize=KB_CACHE)
 def reminder_menu_kb(tid: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("🔔 5 мин", callback_data=f"t:rem5m:{tid}"),
-            InlineKeyboardButton("🔔 30 мин", callback_data=f"t:rem30m:{tid}"),
+            InlineKeyboardButton("🔔 5 мин", callback_data=cb("rem5m", tid)),
+            InlineKeyboardButton("🔔 30 мин", callback_data=cb("rem30m", tid)),
         ],
         [
-            InlineKeyboardButton("🔔 1 час", callback_data=f"t:rem1h:{tid}"),
-            InlineKeyboardButton("🔔 3 часа", callback_data=f"t:rem3h:{tid}"),
-            InlineKeyboardButton("🔔 6 часов", callback_data=f"t:rem6h:{tid}"),
+            InlineKeyboardButton("🔔 1 час", callback_data=cb("rem1h", tid)),
+            InlineKeyboardButton("🔔 3 часа", callback_data=cb("rem3h", tid)),
+            InlineKeyboardButton("🔔 6 часов", callback_data=cb("rem6h", tid)),
         ],
-        [InlineKeyboardButton("🧪 Тест (5 сек)", callback_data=f"t:remtest:{tid}")],
-        [InlineKeyboardButton("🔕 Отключить", callback_data=f"t:remoff:{tid}")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data=f"t:open:{tid}")]
+        [InlineKeyboardButton("🧪 Тест (5 сек)", callback_data=cb("remtest", tid))],
+        [InlineKeyboardButton("🔕 Отключить", callback_data=cb("remoff", tid))],
+        [InlineKeyboardButton("⬅️ Назад", callback_data=cb("open", tid))]
+    ])
+
+@functools.lru_cache(maxsize=KB_CACHE)
+def back_to_task_kb(tid: int, label: str = "⬅️ Назад к задаче") -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=cb("open", tid))]])
+
+@functools.lru_cache(maxsize=KB_CACHE)
+def reminder_set_kb(tid: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("⬅️ Назад к задаче", callback_data=cb("open", tid))],
+        [InlineKeyboardButton("🔕 Отключить", callback_data=cb("remoff", tid))]
     ])
 
-def task_kb(task_id: int, t: Dict[str, Any]) -> InlineKeyboardMarkup:
+@functools.lru_cache(maxsize=KB_CACHE)
+def reminder_tick_kb(tid: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("＋10%", callback_data=f"t:+10:{task_id}"),
-            InlineKeyboardButton("－10%", callback_data=f"t:-10:{task_id}")
+            InlineKeyboardButton("🔔 +5м", callback_data=cb("rem5m", tid)),
+            InlineKeyboardButton("🔔 +30м", callback_data=cb("rem30m", tid)),
+            InlineKeyboardButton("🔔 +1ч", callback_data=cb("rem1h", tid)),
         ],
         [
-            InlineKeyboardButton("📝 Переименовать", callback_data=f"t:ren:{task_id}"),
-            InlineKeyboardButton("🔄 Сброс 0%", callback_data=f"t:reset:{task_id}")
+            InlineKeyboardButton("Открыть карточку", callback_data=cb("open", tid)),
+            InlineKeyboardButton("🔕 Выкл", callback_data=cb("remoff", tid)),
+        ],
+    ])
+
+def reminder_digest_kb(tasks: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
+    # строка на задачу: открыть карточку / выключить её напоминание
+    rows = [[open_task_button(t["id"], short_name(t["name"])),
+             InlineKeyboardButton("🔕", callback_data=cb("remoff", t["id"]))] for t in tasks]
+    rows.append([InlineKeyboardButton("📋 Список", callback_data=cb("list"))])
+    return InlineKeyboardMarkup(rows)
+
+@functools.lru_cache(maxsize=KB_CACHE)
+def reminder_test_kb(tid: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Открыть карточку", callback_data=cb("open", tid))],
+        [InlineKeyboardButton("🔕 Выкл", callback_data=cb("remoff", tid))],
+    ])
+
+@functools.lru_cache(maxsize=KB_CACHE)
+def page_nav_kb(page: int, pages: int) -> InlineKeyboardMarkup:
+    prev_page = cb("list", page - 1) if page > 0 else cb("noop")
+    next_page = cb("list", page + 1) if page < pages - 1 else cb("noop")
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("◀️", callback_data=prev_page),
+        InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=cb("noop")),
+        InlineKeyboardButton("▶️", callback_data=next_page),
+    ]])
+
+def short_name(name: str, limit: int = NAME_LIMIT) -> str:
+    return name if len(name) <= limit else name[:limit - 1] + "…"
+
+@functools.lru_cache(maxsize=CARD_CACHE)
+def open_task_button(tid: int, name: str) -> InlineKeyboardButton:
+    return InlineKeyboardButton(f"Открыть: {name}", callback_data=cb("open", tid))
+
+def task_kb(task_id: int, t: Optional[Dict[str, Any]] = None) -> InlineKeyboardMarkup:
+    return _task_kb(task_id)
+
+@functools.lru_cache(maxsize=KB_CACHE)
+def _task_kb(task_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("＋10%", callback_data=cb("+10", task_id)),
+            InlineKeyboardButton("－10%", callback_data=cb("-10", task_id))
         ],
         [
-            InlineKeyboardButton("🔔 Напоминание", callback_data=f"t:rem:{task_id}"),
-            InlineKeyboardButton("✅ Закрыть", callback_data=f"t:close:{task_id}"),
-            InlineKeyboardButton("🗑 Удалить", callback_data=f"t:del:{task_id}")
+            InlineKeyboardButton("📝 Переименовать", callback_data=cb("ren", task_id)),
+            InlineKeyboardButton("🔄 Сброс 0%", callback_data=cb("reset", task_id))
         ],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="ui:list")],
         [
-            InlineKeyboardButton("➕ Новая", callback_data="ui:new"),
-            InlineKeyboardButton("📋 Список", callback_data="ui:list")
+            InlineKeyboardButton("🔔 Напоминание", callback_data=cb("rem", task_id)),
+            InlineKeyboardButton("✅ Закрыть", callback_data=cb("close", task_id)),
+            InlineKeyboardButton("🗑 Удалить", callback_data=cb("del", task_id))
+        ],
+        [InlineKeyboardButton("⬅️ Назад", callback_data=cb("list"))],
+        [
+            InlineKeyboardButton("➕ Новая", callback_data=cb("new")),
+            InlineKeyboardButton("📋 Список", callback_data=cb("list"))
         ]
     ])
 
 def parse_new_payload(text: str) -> Tuple[str, int]:
     return text.strip(), 0
 
+# ---------- РЕДАКТИРОВАНИЕ СООБЩЕНИЙ ----------
+# Помним отпечаток (текст, клавиатура) последнего рендера каждого сообщения:
+# одинаковый рендер не отправляем в Telegram вовсе. Колбэк уже отвечен в on_buttons.
+EDIT_CACHE = int(os.getenv("EDIT_CACHE", "10000"))
+
+_edit_fp: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+edit_stats = {"sent": 0, "avoided": 0, "not_modified": 0}
+
+def _remember_edit(key: Tuple[int, int], fp: int) -> None:
+    _edit_fp[key] = fp
+    _edit_fp.move_to_end(key)
+    if len(_edit_fp) > EDIT_CACHE:
+        _edit_fp.popitem(last=False)
+
 async def safe_edit(query, text: str, reply_markup=None):
+    msg = query.message if query else None
+    key = (msg.chat.id, msg.message_id) if msg else None
+    fp = hash((text, reply_markup))
+    if key and _edit_fp.get(key) == fp:
+        edit_stats["avoided"] += 1
+        return
+    # сообщение из колбэка и так несёт текущий текст и клавиатуру
+    if msg and getattr(msg, "text", None) == text and getattr(msg, "reply_markup", None) == reply_markup:
+        edit_stats["avoided"] += 1
+        _remember_edit(key, fp)
+        return
     try:
-        if query and query.message and query.message.text == text:
-            await query.answer()
-            return
         await query.edit_message_text(text, reply_markup=reply_markup)
+        edit_stats["sent"] += 1
     except BadRequest as e:
-        if "Message is not modified" in str(e):
-            await query.answer()
-            return
-        raise
+        if "Message is not modified" not in str(e):
+            raise
+        edit_stats["not_modified"] += 1
+    if key:
+        _remember_edit(key, fp)
+
+# ---------- ДВИЖОК НАПОМИНАНИЙ ----------
+# Вместо job'а на каждую задачу — одна куча по времени срабатывания и один
+# периодический тик JobQueue, который за раз забирает все наступившие напоминания.
+REM_TICK = float(os.getenv("REM_TICK", "1"))
+REM_BATCH = int(os.getenv("REM_BATCH", "1000"))
+REM_LATE_SEC = float(os.getenv("REM_LATE_SEC", "5"))
+# REM_DIGEST_WINDOW > 0 — режим сводки: напоминания пользователя, сработавшие в пределах окна
+# от первого из них, уходят одним сообщением (не больше DIGEST_LIMIT задач в тексте и клавиатуре)
+REM_DIGEST_WINDOW = float(os.getenv("REM_DIGEST_WINDOW", "0"))
+DIGEST_LIMIT = int(os.getenv("DIGEST_LIMIT", "20"))
+
+class ReminderEngine:
+    def __init__(self, late_after: float) -> None:
+        self.late_after = late_after
+        self._heap: List[Tuple[float, int, int, int]] = []           # (due, seq, user_id, tid)
+        self._entries: Dict[Tuple[int, int], Tuple[float, int, int]] = {}  # (user_id, tid) -> (due, interval, seq)
+        self._seq = 0
+        self.scheduled = 0
+        self.cancelled = 0
+        self.fired = 0
+        self.late = 0
+        self.max_lag = 0.0
+        self.lag_observers: List[Callable[[float], None]] = []   # получают опоздание каждого срабатывания
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, user_id: int, tid: int, interval: int, due: float) -> None:
+        # O(log n); старая запись в куче остаётся и отбрасывается при извлечении по seq
+        self._seq += 1
+        self._entries[(user_id, tid)] = (due, interval, self._seq)
+        heapq.heappush(self._heap, (due, self._seq, user_id, tid))
+        self.scheduled += 1
+        self._maybe_compact()
+
+    def cancel(self, user_id: int, tid: int) -> bool:
+        if self._entries.pop((user_id, tid), None) is None:
+            return False
+        self.cancelled += 1
+        self._maybe_compact()
+        return True
+
+    def get(self, user_id: int, tid: int) -> Optional[Tuple[float, int]]:
+        entry = self._entries.get((user_id, tid))
+        return (entry[0], entry[1]) if entry else None
 
-# ---------- JOB QUEUE ----------
-def _job_name(user_id: int, tid: int) -> str:
-    return f"rem:{user_id}:{tid}"
+    def pop_due(self, now: float, limit: int) -> List[Tuple[int, int, int, float, bool]]:
+        # забираем наступившие и сразу переставляем их на следующий период;
+        # последний элемент — фаза сдвинулась (пропущены периоды), индекс надо обновить
+        fired: List[Tuple[int, int, int, float, bool]] = []
+        while self._heap and self._heap[0][0] <= now and len(fired) < limit:
+            due, seq, user_id, tid = heapq.heappop(self._heap)
+            entry = self._entries.get((user_id, tid))
+            if entry is None or entry[2] != seq:
+                continue
+            interval = entry[1]
+            lag = now - due
+            self.fired += 1
+            self.max_lag = max(self.max_lag, lag)
+            for observe in self.lag_observers:
+                observe(lag)
+            if lag > self.late_after:
+                self.late += 1
+            next_due = due + interval
+            rephased = next_due <= now
+            if rephased:
+                next_due = now + interval  # пропущенные периоды не догоняем
+            self._seq += 1
+            self._entries[(user_id, tid)] = (next_due, interval, self._seq)
+            heapq.heappush(self._heap, (next_due, self._seq, user_id, tid))
+            fired.append((user_id, tid, interval, next_due, rephased))
+        return fired
+
+    def _maybe_compact(self) -> None:
+        # мусорных записей в куче не больше, чем живых
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            self._heap = [(due, seq, u, t) for (u, t), (due, _, seq) in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._entries),
+            "scheduled": self.scheduled,
+            "cancelled": self.cancelled,
+            "fired": self.fired,
+            "late": self.late,
+            "max_lag": round(self.max_lag, 3),
+        }
+
+reminders = ReminderEngine(REM_LATE_SEC)
+
+class DigestBuffer:
+    # Сработавшие напоминания по пользователям. Срок пачки — первое срабатывание + окно; пачки
+    # добавляются по времени, поэтому dict уже упорядочен по сроку и готовые снимаются с головы.
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._users: Dict[int, Tuple[float, Dict[int, Tuple[int, float]]]] = {}   # user -> (deadline, tid -> (interval, next_due))
+        self.sent = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def add(self, user_id: int, tid: int, interval: int, next_due: float, now: float) -> None:
+        entry = self._users.get(user_id)
+        if entry is None:
+            entry = self._users[user_id] = (now + self.window, {})
+        entry[1][tid] = (interval, next_due)   # повтор той же задачи в окне — одно упоминание
+
+    def snapshot(self) -> Dict[str, List[Tuple[int, int, float]]]:
+        return {str(user_id): [(tid, interval, next_due) for tid, (interval, next_due) in items.items()]
+                for user_id, (_, items) in self._users.items()}
+
+    def restore(self, snapshot: Dict[str, List[Tuple[int, int, float]]], now: float) -> None:
+        for user_id, items in snapshot.items():
+            for tid, interval, next_due in items:
+                self.add(int(user_id), int(tid), int(interval), float(next_due), now)
+
+    def pop_ready(self, now: float) -> List[Tuple[int, Dict[int, Tuple[int, float]]]]:
+        ready = []
+        for user_id, (deadline, items) in self._users.items():
+            if deadline > now:
+                break
+            ready.append((user_id, items))
+        for user_id, items in ready:
+            del self._users[user_id]
+            self.sent += 1
+            self.coalesced += len(items)
+        return ready
+
+digests = DigestBuffer(REM_DIGEST_WINDOW)
 
 def _cancel_reminder(app: Application, user_id: int, tid: int) -> None:
-    for job in app.job_queue.get_jobs_by_name(_job_name(user_id, tid)):
-        job.schedule_removal()
-    logger.info(f"REM: cancel user={user_id} tid={tid}")
-
-def _schedule_reminder(app: Application, user_id: int, tid: int, interval: int) -> None:
-    _cancel_reminder(app, user_id, tid)
-    app.job_queue.run_repeating(
-        reminder_tick,
-        interval=interval,
-        first=interval,
-        name=_job_name(user_id, tid),
-        data={"user_id": user_id, "tid": tid},
-    )
-    logger.info(f"REM: schedule user={user_id} tid={tid} every={interval}s")
+    reminders.cancel(user_id, tid)
+    storage.reminder_del(user_id, tid)
+    log_event("REM: cancel", user=user_id, tid=tid)
 
-async def reminder_tick(context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = context.job.data["user_id"]
-    tid = context.job.data["tid"]
-    data = load_tasks(user_id)
-    t = data["tasks"].get(str(tid))
-    if not t:
-        _cancel_reminder(context.application, user_id, tid)
-        return
+def _schedule_reminder(app: Application, user_id: int, tid: int, interval: int, first: Optional[float] = None) -> None:
+    # first — через сколько секунд первый тик; по умолчанию через полный интервал
+    first = interval if first is None else max(1.0, first)
+    due = time.time() + first
+    reminders.add(user_id, tid, interval, due)
+    storage.reminder_set(user_id, tid, interval, due)
+    log_event("REM: schedule", user=user_id, tid=tid, every=interval, first=round(first))
+
+async def reminders_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    app = context.application
+    now = time.time()
+    for user_id, tid, interval, next_due, rephased in reminders.pop_due(now, REM_BATCH):
+        if rephased:   # обычное срабатывание остаётся в фазе индекса — писать нечего
+            storage.reminder_set(user_id, tid, interval, next_due)
+        if REM_DIGEST_WINDOW > 0:
+            digests.add(user_id, tid, interval, next_due, now)
+        else:
+            app.create_task(reminder_tick(app, user_id, tid))
+    for user_id, items in digests.pop_ready(now):
+        tids = _align_digest(user_id, items)
+        if len(tids) == 1:
+            app.create_task(reminder_tick(app, user_id, tids[0]))
+        elif tids:
+            app.create_task(reminder_digest(app, user_id, tids))
+
+def _align_digest(user_id: int, items: Dict[int, Tuple[int, float]]) -> List[int]:
+    # задачи с одинаковым интервалом переводим на один срок — со следующего круга
+    # они сработают в одном тике и окно ждать не придётся
+    live: Dict[int, List[Tuple[int, float]]] = {}
+    for tid, (interval, next_due) in items.items():
+        entry = reminders.get(user_id, tid)
+        # не отменено и не переставлено за окно; допуск — после рестарта срок заново выведен
+        # из якоря индекса и может отличаться от снимка в последних знаках
+        if entry and entry[1] == interval and abs(entry[0] - next_due) < 1.0:
+            live.setdefault(interval, []).append((tid, entry[0]))
+    tids = []
+    for interval, group in live.items():
+        due = min(d for _, d in group)
+        for tid, next_due in group:
+            tids.append(tid)
+            if next_due != due:
+                reminders.add(user_id, tid, interval, due)
+                storage.reminder_set(user_id, tid, interval, due)
+    return sorted(tids)
+
+# ---------- ИСХОДЯЩАЯ ОЧЕРЕДЬ ----------
+# Напоминания не шлём напрямую: они идут через очередь с общим лимитом (~30 msg/s),
+# лимитом на чат (~1 msg/s) и несколькими воркерами. RetryAfter ставит всю отправку на паузу.
+SEND_RATE = float(os.getenv("SEND_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+SEND_QUEUE_MAX = int(os.getenv("SEND_QUEUE_MAX", "10000"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        # 0 — токен взят; иначе сколько секунд подождать
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class SendPipeline:
+    def __init__(self, rate: float, chat_rate: float, workers: int, maxsize: int) -> None:
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self.maxsize = maxsize
+        self._chat_next: Dict[int, float] = {}   # chat_id -> когда освободится следующий слот
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._paused_until = 0.0
+        self._delayed: Dict[asyncio.TimerHandle, Tuple] = {}   # ждут слота или повтора
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.leftover: List[Tuple] = []   # не доставлены к остановке — уходят в снимок состояния
+
+    def start(self, bot) -> None:
+        self.bot = bot
+        self._queue = asyncio.Queue(self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        # даём очереди дослаться, потом гасим воркеров
+        if self._queue is None:
+            return
+        try:
+            deadline = time.monotonic() + timeout
+            while (self._delayed or not self._queue.empty()) and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            await asyncio.wait_for(self._queue.join(), max(0.1, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            logger.warning(f"SEND: stop with {self._queue.qsize() + len(self._delayed)} undelivered")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # отложенные (ждут слота чата или повтора) — тоже в снимок, а не в очередь без воркеров
+        for handle, item in self._delayed.items():
+            handle.cancel()
+            self.leftover.append(item)
+        self._delayed.clear()
+        while not self._queue.empty():
+            self.leftover.append(self._queue.get_nowait())
+
+    def submit(self, chat_id: int, text: str, reply_markup=None, tag: str = "") -> bool:
+        if self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait((chat_id, text, reply_markup, tag, 1, False))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            log_event("SEND: queue full, drop", logging.WARNING, chat=chat_id, tag=tag)
+            return False
+
+    def _later(self, delay: float, item: Tuple) -> None:
+        # откладываем без блокировки воркера
+        def _put() -> None:
+            self._delayed.pop(handle, None)
+            try:
+                self._queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                log_event("SEND: queue full, drop", logging.WARNING, chat=item[0], tag=item[3])
+        handle = asyncio.get_running_loop().call_later(delay, _put)
+        self._delayed[handle] = item
+
+    def _chat_slot(self, chat_id: int) -> float:
+        # резервируем слот чата сразу: 0 — можно слать, иначе через сколько секунд наш слот
+        now = time.monotonic()
+        if len(self._chat_next) > 10_000:
+            self._chat_next = {k: t for k, t in self._chat_next.items() if t > now}
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + 1 / self.chat_rate
+        return slot - now
+
+    async def _worker(self, n: int) -> None:
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._deliver(item)
+            except Exception as e:
+                logger.error(f"SEND: worker={n} err={e}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, item: Tuple) -> None:
+        chat_id, text, reply_markup, tag, attempt, slotted = item
+        if not slotted:
+            wait = self._chat_slot(chat_id)
+            if wait > 0:
+                # слот уже наш — повторно чат не проверяем
+                self._later(wait, (chat_id, text, reply_markup, tag, attempt, True))
+                return
+        while True:
+            wait = max(self._paused_until - time.monotonic(), self.bucket.take())
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+            self.sent += 1
+            log_event("SEND: ok", sample=LOG_SAMPLE, chat=chat_id, tag=tag)
+        except RetryAfter as e:
+            self._failure(e)
+            ra = e.retry_after
+            delay = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+            self._paused_until = time.monotonic() + delay
+            self._retry(item, delay, e)
+        except BadRequest as e:
+            self._failure(e)
+            self.failed += 1
+            log_event("SEND: failed", logging.WARNING, chat=chat_id, tag=tag, err=e)
+        except (TimedOut, NetworkError) as e:
+            self._failure(e)
+            self._retry(item, min(60.0, 2.0 ** attempt), e)
+        except Exception as e:
+            self._failure(e)
+            self.failed += 1
+            log_event("SEND: failed", logging.WARNING, chat=chat_id, tag=tag, err=e)
+
+    def _failure(self, err: Exception) -> None:
+        metrics.counter("taskbot_send_failures_total", "Ошибки отправки по типу", error=type(err).__name__).inc()
+
+    def _retry(self, item: Tuple, delay: float, err: Exception) -> None:
+        chat_id, text, reply_markup, tag, attempt, _ = item
+        if attempt >= SEND_MAX_ATTEMPTS:
+            self.failed += 1
+            log_event("SEND: give up", logging.WARNING, chat=chat_id, tag=tag, attempts=attempt, err=err)
+            return
+        self.retried += 1
+        self._later(delay, (chat_id, text, reply_markup, tag, attempt + 1, False))
+
+outbox = SendPipeline(SEND_RATE, SEND_CHAT_RATE, SEND_WORKERS, SEND_QUEUE_MAX)
+
+async def reminder_tick(app: Application, user_id: int, tid: int) -> None:
+    async with user_lock(user_id):
+        data = await load_tasks(user_id)
+        t = data["tasks"].get(str(tid))
+        if not t:
+            _cancel_reminder(app, user_id, tid)
+            return
     text = f"Напоминание по задаче: {t['name']}\nОткрыть, продлить или отключить?"
-    kb = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("🔔 +5м", callback_data=f"t:rem5m:{tid}"),
-            InlineKeyboardButton("🔔 +30м", callback_data=f"t:rem30m:{tid}"),
-            InlineKeyboardButton("🔔 +1ч", callback_data=f"t:rem1h:{tid}"),
-        ],
-        [
-            InlineKeyboardButton("Открыть карточку", callback_data=f"t:open:{tid}"),
-            InlineKeyboardButton("🔕 Выкл", callback_data=f"t:remoff:{tid}"),
-        ],
-    ])
-    try:
-        await context.bot.send_message(chat_id=user_id, text=text, reply_markup=kb)
-        logger.info(f"REM: tick sent user={user_id} tid={tid}")
-    except Exception as e:
-        logger.warning(f"REM: tick failed user={user_id} tid={tid} err={e}")
+    kb = reminder_tick_kb(tid)
+    if outbox.submit(user_id, text, kb, tag=f"rem:{tid}"):
+        log_event("REM: tick queued", sample=LOG_SAMPLE, user=user_id, tid=tid)
+
+async def reminder_digest(app: Application, user_id: int, tids: List[int]) -> None:
+    async with user_lock(user_id):
+        data = await load_tasks(user_id)
+        tasks = []
+        for tid in tids:
+            t = data["tasks"].get(str(tid))
+            if t:
+                tasks.append(t)
+            else:
+                _cancel_reminder(app, user_id, tid)
+    if not tasks:
+        return
+    shown = tasks[:DIGEST_LIMIT]
+    lines = [f"Напоминания по задачам ({len(tasks)}):", ""]
+    lines += [f"{t['id']}. {short_name(t['name'])} — {progress_bar(int(t.get('progress', 0)))}" for t in shown]
+    if len(tasks) > len(shown):
+        lines.append(f"… и ещё {len(tasks) - len(shown)}")
+    if outbox.submit(user_id, "\n".join(lines), reminder_digest_kb(shown), tag=f"digest:{len(tasks)}"):
+        log_event("REM: digest queued", sample=LOG_SAMPLE, user=user_id, tasks=len(tasks))
 
 async def reminder_test_once(context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = context.job.data["user_id"]
     tid = context.job.data["tid"]
-    data = load_tasks(user_id)
+    data = await load_tasks(user_id)
     t = data["tasks"].get(str(tid))
     if not t:
         return
     text = f"Тест-напоминание (5 сек): {t['name']}"
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("Открыть карточку", callback_data=f"t:open:{tid}")],
-        [InlineKeyboardButton("🔕 Выкл", callback_data=f"t:remoff:{tid}")],
-    ])
+    kb = reminder_test_kb(tid)
+    if outbox.submit(user_id, text, kb, tag=f"remtest:{tid}"):
+        log_event("REM: test queued", user=user_id, tid=tid)
+
+# ---------- ИМПОРТ / ЭКСПОРТ ----------
+# /import принимает текст (строка — задача) или файл JSON/CSV и применяет все операции к документу
+# за одну загрузку и одну запись. Строки текста:
+#   Название | 40 | 1h   — создать (прогресс и напоминание необязательны)
+#   #12 Название | 60    — изменить задачу 12 (пустые поля не трогаются; нет такой — создать)
+#   -#12                 — закрыть задачу 12
+# JSON — формат /export (или просто список задач): задача с существующим id обновляется,
+# без id или с неизвестным — создаётся, "closed": true — закрывается, "reminder_interval": null —
+# напоминание выключается (повторный импорт выгрузки возвращает задачи к её состоянию).
+# CSV — колонки id,name,progress,reminder.
+IMPORT_MAX = int(os.getenv("IMPORT_MAX", "1000"))            # операций за один импорт
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(1024 * 1024)))
+IMPORT_ERRORS_SHOWN = 10
+EXPORT_FORMAT = "taskbot-export"
+
+class ImportFormatError(ValueError):
+    pass
+
+def _parse_progress(raw: Any) -> Optional[int]:
+    if raw is None or str(raw).strip() == "":
+        return None
     try:
-        await context.bot.send_message(chat_id=user_id, text=text, reply_markup=kb)
-        logger.info(f"REM: test sent user={user_id} tid={tid}")
+        return max(0, min(100, int(str(raw).strip().rstrip("%"))))
+    except ValueError:
+        raise ImportFormatError(f"прогресс {raw!r}")
+
+def _parse_interval(raw: Any) -> Any:
+    # None — не менять, 0 — выключить, иначе секунды одного из REM_OPTIONS
+    if raw is None or str(raw).strip() == "":
+        return None
+    value = str(raw).strip().lower()
+    if value in ("off", "0", "-", "null", "none"):
+        return 0
+    if value in REM_OPTIONS:
+        return REM_OPTIONS[value]
+    if value.isdigit() and int(value) in REM_LABELS:
+        return int(value)
+    raise ImportFormatError(f"напоминание {raw!r} (можно: {', '.join(REM_OPTIONS)}, off)")
+
+def _op(tid: Optional[int], name: Any, progress: Any, interval: Any, close: bool = False) -> Dict[str, Any]:
+    name = str(name).strip() if name is not None else ""
+    if tid is None and not name and not close:
+        raise ImportFormatError("нет названия")
+    return {"tid": tid, "name": name, "progress": _parse_progress(progress),
+            "interval": _parse_interval(interval), "close": close}
+
+def parse_import_text(text: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+    ops, errors = [], []
+    for n, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            close = line.startswith("-#")
+            head, *fields = [part.strip() for part in line.lstrip("-").split("|")]
+            tid = None
+            if head.startswith("#"):
+                sid, _, head = head[1:].partition(" ")
+                if not sid.isdigit():
+                    raise ImportFormatError(f"id {sid!r}")
+                tid = int(sid)
+            ops.append(_op(tid, head, *(fields + [None, None])[:2], close=close))
+        except ImportFormatError as e:
+            errors.append(f"строка {n}: {e}")
+    return ops, errors
+
+def parse_import_json(raw: bytes) -> Tuple[List[Dict[str, Any]], List[str]]:
+    try:
+        doc = _loads(raw)
     except Exception as e:
-        logger.warning(f"REM: test failed user={user_id} tid={tid} err={e}")
+        raise ImportFormatError(f"не JSON: {e}")
+    items = doc.get("tasks") if isinstance(doc, dict) else doc
+    if isinstance(items, dict):   # документ хранилища: {"tasks": {id: task}}
+        items = list(items.values())
+    if not isinstance(items, list):
+        raise ImportFormatError("ожидался список задач или файл /export")
+    ops, errors = [], []
+    for n, item in enumerate(items, 1):
+        try:
+            if not isinstance(item, dict):
+                raise ImportFormatError("не объект")
+            tid = item.get("id")
+            if "reminder_interval" in item:
+                # как в /export: явный null — напоминания нет, его надо выключить
+                interval = item["reminder_interval"] or "off"
+            else:
+                interval = item.get("reminder")
+            ops.append(_op(int(tid) if tid is not None else None, item.get("name"), item.get("progress"),
+                           interval, close=bool(item.get("closed"))))
+        except (ImportFormatError, TypeError, ValueError) as e:
+            errors.append(f"задача {n}: {e}")
+    return ops, errors
+
+def parse_import_csv(raw: bytes) -> Tuple[List[Dict[str, Any]], List[str]]:
+    rows = csv.DictReader(io.StringIO(raw.decode("utf-8-sig")))
+    if not rows.fieldnames or "name" not in rows.fieldnames:
+        raise ImportFormatError("в CSV нужна колонка name (и необязательные id, progress, reminder, closed)")
+    ops, errors = [], []
+    for n, row in enumerate(rows, 2):
+        try:
+            sid = (row.get("id") or "").strip()
+            if sid and not sid.isdigit():
+                raise ImportFormatError(f"id {sid!r}")
+            closed = (row.get("closed") or "").strip().lower() in ("1", "true", "yes", "да")
+            ops.append(_op(int(sid) if sid else None, row.get("name"), row.get("progress"), row.get("reminder"), close=closed))
+        except ImportFormatError as e:
+            errors.append(f"строка {n}: {e}")
+    return ops, errors
+
+def parse_import_file(filename: str, raw: bytes) -> Tuple[List[Dict[str, Any]], List[str]]:
+    if len(raw) > IMPORT_MAX_BYTES:
+        raise ImportFormatError(f"файл больше {IMPORT_MAX_BYTES // 1024} КБ")
+    if filename.lower().endswith(".csv"):
+        return parse_import_csv(raw)
+    if filename.lower().endswith(".json") or raw.lstrip()[:1] in (b"{", b"["):
+        return parse_import_json(raw)
+    return parse_import_text(raw.decode("utf-8-sig"))
+
+def apply_import(app: Application, user_id: int, data: Dict[str, Any],
+                 ops: List[Dict[str, Any]]) -> Tuple[Dict[str, int], List[str]]:
+    # все операции — над одним документом в памяти; запись и напоминания — один раз, пачкой
+    counts = {"created": 0, "updated": 0, "closed": 0}
+    errors: List[str] = []
+    rem_set: Dict[int, int] = {}
+    rem_off: Set[int] = set()
+    for n, op in enumerate(ops, 1):
+        tid = op["tid"]
+        t = data["tasks"].get(str(tid)) if tid is not None else None
+        if op["close"]:
+            if t is None:
+                errors.append(f"#{tid}: нет такой задачи")
+                continue
+            remove_task(data, tid)
+            data["stats"]["closed"] = int(data["stats"].get("closed", 0)) + 1
+            rem_set.pop(tid, None)
+            rem_off.add(tid)
+            counts["closed"] += 1
+            continue
+        if t is None:
+            if not op["name"]:
+                errors.append(f"#{tid}: нет такой задачи")
+                continue
+            tid = add_task(data, op["name"])
+            t = data["tasks"][str(tid)]
+            counts["created"] += 1
+        else:
+            if op["name"]:
+                t["name"] = op["name"]
+            counts["updated"] += 1
+        if op["progress"] is not None:
+            t["progress"] = op["progress"]
+        interval = op["interval"]
+        if interval is not None and interval != (t.get("reminder_interval") or 0):
+            t["reminder_interval"] = interval or None
+            if interval:
+                rem_set[tid] = interval
+                rem_off.discard(tid)
+            else:
+                rem_set.pop(tid, None)
+                rem_off.add(tid)
+    if any(counts.values()):
+        save_tasks(user_id, data)
+    for tid in rem_off:
+        _cancel_reminder(app, user_id, tid)
+    for tid, interval in rem_set.items():
+        _schedule_reminder(app, user_id, tid, interval)
+    log_event("TASK: import", user=user_id, reminders=len(rem_set), errors=len(errors), **counts)
+    return counts, errors
+
+def export_doc(data: Dict[str, Any]) -> bytes:
+    tasks = [data["tasks"][str(tid)] for tid in data["order"]]
+    return json.dumps({
+        "format": EXPORT_FORMAT,
+        "version": 1,
+        "stats": data["stats"],
+        "tasks": [{"id": t["id"], "name": t["name"], "progress": int(t.get("progress", 0)),
+                   "reminder_interval": t.get("reminder_interval")} for t in tasks],
+    }, ensure_ascii=False, indent=1).encode("utf-8")
 
 # ---------- ХЕНДЛЕРЫ ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -227,6 +1991,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Привет! Это минималистичный трекер-напоминалка.\n"
         "/new Название — создать\n"
         "/list — список\n"
+        "/import — загрузить много задач (текст или файл JSON/CSV)\n"
+        "/export — выгрузить задачи файлом\n"
         "/stats — статистика\n"
         "/debugrem — активные напоминания"
     )
@@ -240,40 +2006,109 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    data = load_tasks(user_id)
+    data = await load_tasks(user_id)
     opened = len(data["tasks"])
     closed = data["stats"]["closed"]
     await update.message.reply_text(f"Статистика: открытых {opened}, закрытых {closed}", reply_markup=main_menu_kb())
 
 async def debugrem_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    data = load_tasks(user_id)
+    data = await load_tasks(user_id)
     rows = []
-    for sid, t in sorted(data["tasks"].items(), key=lambda x: int(x[0])):
+    active = 0
+    for tid in data["order"]:
+        t = data["tasks"][str(tid)]
         if t.get("reminder_interval"):
-            rows.append(f"{sid}. {t['name']} — {progress_bar(int(t.get('progress',0)))}")
+            active += 1
+            if active <= DEBUGREM_LIMIT:
+                rows.append(f"{tid}. {short_name(t['name'])} — {progress_bar(int(t.get('progress',0)))}")
+    if active > DEBUGREM_LIMIT:
+        rows.append(f"… и ещё {active - DEBUGREM_LIMIT}")
     txt = "Активные напоминания:\n" + ("\n".join(rows) if rows else "нет")
+    st = reminders.stats()
+    txt += f"\n\nДвижок: активных {st['active']}, сработало {st['fired']}, с опозданием {st['late']}"
+    txt += f"\nЗадержка loop: {loop_lag.last * 1000:.0f} мс, макс {loop_lag.max * 1000:.0f} мс"
+    txt += f"\nПравки: отправлено {edit_stats['sent']}, пропущено {edit_stats['avoided']}"
     await update.message.reply_text(txt, reply_markup=main_menu_kb())
 
 async def new_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    data = load_tasks(user_id)
+    data = await load_tasks(user_id)
     raw = " ".join(context.args) if context.args else ""
     if not raw:
         context.user_data["awaiting"] = {"mode": "new"}
         await update.message.reply_text("Введи название задачи", reply_markup=main_menu_kb())
         return
     name, _ = parse_new_payload(raw)
-    data["seq"] += 1
-    tid = data["seq"]
-    data["tasks"][str(tid)] = {"id": tid, "name": name, "progress": 0, "reminder_interval": None}
+    tid = add_task(data, name)
     save_tasks(user_id, data)
-    logger.info(f"TASK: create user={user_id} tid={tid} name={name}")
+    log_event("TASK: create", user=user_id, tid=tid, name=name)
     await update.message.reply_text(task_line(data["tasks"][str(tid)]), reply_markup=task_kb(tid, data["tasks"][str(tid)]))
 
-async def list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def import_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    parts = (update.message.text or "").split(None, 1)
+    if len(parts) < 2:
+        context.user_data["awaiting"] = {"mode": "import"}
+        await update.message.reply_text(
+            "Пришли задачи — по одной в строке (Название | 40 | 1h; #12 Новое имя; -#12 — закрыть) "
+            "или файлом .json/.csv",
+            reply_markup=back_to_menu_kb(),
+        )
+        return
+    await run_import(update, context, *parse_import_text(parts[1]))
+
+async def run_import(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                     ops: List[Dict[str, Any]], errors: List[str]) -> None:
+    context.user_data["awaiting"] = None
+    user_id = update.effective_user.id
+    if len(ops) > IMPORT_MAX:
+        await update.message.reply_text(f"Слишком много задач: {len(ops)}, можно до {IMPORT_MAX} за раз.",
+                                        reply_markup=main_menu_kb())
+        return
+    data = await load_tasks(user_id)
+    counts, apply_errors = apply_import(context.application, user_id, data, ops)
+    errors += apply_errors
+    lines = [f"Импорт: создано {counts['created']}, изменено {counts['updated']}, "
+             f"закрыто {counts['closed']}, ошибок {len(errors)}"]
+    lines += errors[:IMPORT_ERRORS_SHOWN]
+    if len(errors) > IMPORT_ERRORS_SHOWN:
+        lines.append(f"… и ещё {len(errors) - IMPORT_ERRORS_SHOWN}")
+    await update.message.reply_text("\n".join(lines), reply_markup=main_menu_kb())
+
+async def on_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # файл принимается после /import или с подписью /import
+    awaiting = context.user_data.get("awaiting") or {}
+    caption = (update.message.caption or "").strip()
+    if awaiting.get("mode") != "import" and not caption.startswith("/import"):
+        await update.message.reply_text("Чтобы загрузить задачи из файла, отправь его после /import.",
+                                        reply_markup=main_menu_kb())
+        return
+    doc = update.message.document
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text(f"Файл больше {IMPORT_MAX_BYTES // 1024} КБ.", reply_markup=main_menu_kb())
+        return
+    raw = bytes(await (await doc.get_file()).download_as_bytearray())
+    try:
+        ops, errors = parse_import_file(doc.file_name or "", raw)
+    except (ImportFormatError, UnicodeDecodeError) as e:
+        context.user_data["awaiting"] = None
+        await update.message.reply_text(f"Не получилось прочитать файл: {e}", reply_markup=main_menu_kb())
+        return
+    await run_import(update, context, ops, errors)
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    data = await load_tasks(user_id)
+    payload = export_doc(data)
+    await update.message.reply_document(
+        document=payload, filename=f"tasks-{user_id}.json",
+        caption=f"Задач: {len(data['tasks'])}. Загрузить обратно — /import с этим файлом.",
+    )
+    log_event("TASK: export", user=user_id, tasks=len(data["tasks"]), bytes=len(payload))
+
+async def list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE, page: Optional[int] = None) -> None:
     user_id = update.effective_user.id
-    data = load_tasks(user_id)
+    data = await load_tasks(user_id)
     opened = len(data["tasks"])
     closed = data["stats"]["closed"]
     if not data["tasks"]:
@@ -283,165 +2118,179 @@ async def list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         else:
             await safe_edit(update.callback_query, txt, reply_markup=main_menu_kb())
         return
+    # рендерим только видимую страницу; номер запоминаем для «⬅️ Назад» из карточки
+    pages = (opened + PAGE_SIZE - 1) // PAGE_SIZE
+    if page is None:
+        page = context.user_data.get("list_page", 0)
+    page = max(0, min(pages - 1, page))
+    context.user_data["list_page"] = page
     lines = [f"Открытых: {opened} | Закрытых: {closed}", ""]
     keyboard = []
-    for sid, t in sorted(data["tasks"].items(), key=lambda x: int(x[0])):
-        tid = int(sid)
-        lines.append(f"{tid}. {t['name']} — {progress_bar(int(t.get('progress',0)))}")
-        keyboard.append([InlineKeyboardButton(f"Открыть: {t['name']}", callback_data=f"t:open:{tid}")])
+    for tid in data["order"][page * PAGE_SIZE:(page + 1) * PAGE_SIZE]:
+        t = data["tasks"][str(tid)]
+        lines.append(f"{tid}. {short_name(t['name'])} — {progress_bar(int(t.get('progress',0)))}")
+        keyboard.append([open_task_button(tid, short_name(t["name"]))])
+    if pages > 1:
+        keyboard.append(list(page_nav_kb(page, pages).inline_keyboard[0]))
     text = "\n".join(lines)
-    kb = InlineKeyboardMarkup(keyboard + [[InlineKeyboardButton("⬅️ Меню", callback_data="ui:menu")]])
+    kb = InlineKeyboardMarkup(keyboard + list(back_to_menu_kb().inline_keyboard))
     if update.message:
         await update.message.reply_text(text, reply_markup=kb)
     else:
         await safe_edit(update.callback_query, text, reply_markup=kb)
 
+# Кнопки: таблица действие -> (обработчик, что ему нужно). Документ пользователя читается
+# только для действий над задачами; навигация (меню, список, пустые кнопки) его не трогает.
+BTN_NO_DATA, BTN_DOC, BTN_TASK = 0, 1, 2   # BTN_TASK — задача должна существовать
+BUTTONS: Dict[str, Tuple[Callable[..., Awaitable[None]], int]] = {}
+
+def button(*actions: str, needs: int = BTN_NO_DATA):
+    def register(handler):
+        for action in actions:
+            BUTTONS[action] = (handler, needs)
+        return handler
+    return register
+
 async def on_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query
     await q.answer()
-    user_id = update.effective_user.id
-    data = load_tasks(user_id)
     if not q.data:
         return
-
-    if q.data == "ui:menu":
-        context.user_data["awaiting"] = None
-        await safe_edit(q, "Главное меню", reply_markup=main_menu_kb())
-        return
-    if q.data == "ui:new":
-        context.user_data["awaiting"] = {"mode": "new"}
-        await safe_edit(q, "Введи название новой задачи", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Меню", callback_data="ui:menu")]]))
-        return
-    if q.data == "ui:list":
-        await list_cmd(update, context)
-        return
-    if q.data == "noop":
+    action, args = decode_cb(q.data)
+    entry = BUTTONS.get(action)
+    if entry is None:
         return
-    if q.data.startswith("t:rem:"):
-        try:
-            _, _, sid = q.data.split(":")
-            tid = int(sid)
-        except Exception:
+    handler, needs = entry
+    arg = args[0] if args else None
+    data = None
+    if needs != BTN_NO_DATA:
+        if arg is None:
             return
-        t = data["tasks"].get(str(tid))
-        if not t:
+        data = await load_tasks(update.effective_user.id)
+        if needs == BTN_TASK and str(arg) not in data["tasks"]:
             await safe_edit(q, "Эта задача уже отсутствует.", reply_markup=main_menu_kb())
             return
-        await safe_edit(q, f"Напоминания для: {t['name']}", reply_markup=reminder_menu_kb(tid))
-        return
+    await handler(update, context, action, arg, data)
 
-    parts = q.data.split(":")
-    try:
-        if len(parts) == 3:
-            _, action, sid = parts
-            tid = int(sid)
-        elif len(parts) == 4:
-            _, action, _, sid = parts
-            tid = int(sid)
-        else:
-            return
-    except Exception:
-        return
+@button("menu")
+async def btn_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, arg: Optional[int], data) -> None:
+    context.user_data["awaiting"] = None
+    await safe_edit(update.callback_query, "Главное меню", reply_markup=main_menu_kb())
 
-    t = data["tasks"].get(str(tid))
-    if action not in {"rem5m", "rem30m", "rem1h", "rem3h", "rem6h", "remoff", "remtest"} and not t and action not in {"close"}:
-        await safe_edit(q, "Эта задача уже отсутствует.", reply_markup=main_menu_kb())
-        return
+@button("new")
+async def btn_new(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, arg: Optional[int], data) -> None:
+    context.user_data["awaiting"] = {"mode": "new"}
+    await safe_edit(update.callback_query, "Введи название новой задачи", reply_markup=back_to_menu_kb())
 
-    if action in {"rem5m", "rem30m", "rem1h", "rem3h", "rem6h"}:
-        key = action.replace("rem","")
-        seconds = {
-            "5m": REM_OPTIONS["5m"],
-            "30m": REM_OPTIONS["30m"],
-            "1h": REM_OPTIONS["1h"],
-            "3h": REM_OPTIONS["3h"],
-            "6h": REM_OPTIONS["6h"],
-        }[key]
-        if t:
-            t["reminder_interval"] = seconds
-            save_tasks(user_id, data)
-        _schedule_reminder(context.application, user_id, tid, seconds)
-        await safe_edit(q, f"Напоминание каждые {key} установлено.", reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("⬅️ Назад к задаче", callback_data=f"t:open:{tid}")],
-            [InlineKeyboardButton("🔕 Отключить", callback_data=f"t:remoff:{tid}")]
-        ]))
-        return
+@button("list")
+async def btn_list(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, arg: Optional[int], data) -> None:
+    await list_cmd(update, context, arg)   # arg — страница; None — последняя открытая
 
-    if action == "remoff":
-        if t:
-            t["reminder_interval"] = None
-            save_tasks(user_id, data)
-        _cancel_reminder(context.application, user_id, tid)
-        await safe_edit(q, "Напоминания отключены.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад к задаче", callback_data=f"t:open:{tid}")]]))
-        return
+@button("noop")
+async def btn_noop(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, arg: Optional[int], data) -> None:
+    pass
 
-    if action == "remtest":
-        context.application.job_queue.run_once(reminder_test_once, when=5, data={"user_id": user_id, "tid": tid})
-        await safe_edit(q, "Тест-напоминание придёт через 5 секунд.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад к задаче", callback_data=f"t:open:{tid}")]]))
-        return
+@button("rem", needs=BTN_TASK)
+async def btn_rem_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, tid: int, data) -> None:
+    t = data["tasks"][str(tid)]
+    await safe_edit(update.callback_query, f"Напоминания для: {t['name']}", reply_markup=reminder_menu_kb(tid))
 
-    if not t and action != "close":
-        await safe_edit(q, "Эта задача уже отсутствует.", reply_markup=main_menu_kb())
-        return
+@button("rem5m", "rem30m", "rem1h", "rem3h", "rem6h", needs=BTN_DOC)
+async def btn_rem_set(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, tid: int, data) -> None:
+    user_id = update.effective_user.id
+    key = action[len("rem"):]
+    seconds = REM_OPTIONS[key]
+    t = data["tasks"].get(str(tid))
+    if t:
+        t["reminder_interval"] = seconds
+        save_tasks(user_id, data)
+    _schedule_reminder(context.application, user_id, tid, seconds)
+    await safe_edit(update.callback_query, f"Напоминание каждые {key} установлено.", reply_markup=reminder_set_kb(tid))
 
-    if action == "open":
-        await safe_edit(q, task_line(t), reply_markup=task_kb(tid, t))
+@button("remoff", needs=BTN_DOC)
+async def btn_rem_off(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, tid: int, data) -> None:
+    user_id = update.effective_user.id
+    t = data["tasks"].get(str(tid))
+    if t:
+        t["reminder_interval"] = None
+        save_tasks(user_id, data)
+    _cancel_reminder(context.application, user_id, tid)
+    await safe_edit(update.callback_query, "Напоминания отключены.", reply_markup=back_to_task_kb(tid))
+
+@button("remtest")
+async def btn_rem_test(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, tid: Optional[int], data) -> None:
+    if tid is None:
         return
+    context.application.job_queue.run_once(reminder_test_once, when=5, data={"user_id": update.effective_user.id, "tid": tid})
+    await safe_edit(update.callback_query, "Тест-напоминание придёт через 5 секунд.", reply_markup=back_to_task_kb(tid))
 
+@button("open", needs=BTN_TASK)
+async def btn_open(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, tid: int, data) -> None:
+    t = data["tasks"][str(tid)]
+    await safe_edit(update.callback_query, task_line(t), reply_markup=task_kb(tid, t))
+
+@button("+10", "-10", "reset", needs=BTN_TASK)
+async def btn_progress(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, tid: int, data) -> None:
+    t = data["tasks"][str(tid)]
+    before = int(t.get("progress", 0))
     if action == "+10":
-        t["progress"] = min(100, int(t.get("progress", 0)) + 10)
+        t["progress"] = min(100, before + 10)
     elif action == "-10":
-        t["progress"] = max(0, int(t.get("progress", 0)) - 10)
-    elif action == "reset":
+        t["progress"] = max(0, before - 10)
+    else:
         t["progress"] = 0
-    elif action == "ren":
-        context.user_data["awaiting"] = {"mode": "rename", "id": tid}
-        await safe_edit(q, "Введи новое название задачи:", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"t:open:{tid}")]]))
-        return
-    elif action == "del":
-        _cancel_reminder(context.application, user_id, tid)
-        if str(tid) in data["tasks"]:
-            del data["tasks"][str(tid)]
-        save_tasks(user_id, data)
-        logger.info(f"TASK: delete user={user_id} tid={tid}")
-        await list_cmd(update, context)
-        return
-    elif action == "close":
-        _cancel_reminder(context.application, user_id, tid)
-        if str(tid) in data["tasks"]:
-            del data["tasks"][str(tid)]
-        data["stats"]["closed"] = int(data["stats"].get("closed", 0)) + 1
-        save_tasks(user_id, data)
-        logger.info(f"TASK: close user={user_id} tid={tid}")
-        await list_cmd(update, context)
-        return
+    if t["progress"] != before:  # +10% на 100% ничего не меняет — не пишем и не редактируем
+        save_tasks(update.effective_user.id, data)
+    await safe_edit(update.callback_query, task_line(t), reply_markup=task_kb(tid, t))
+
+@button("ren", needs=BTN_TASK)
+async def btn_rename(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, tid: int, data) -> None:
+    context.user_data["awaiting"] = {"mode": "rename", "id": tid}
+    await safe_edit(update.callback_query, "Введи новое название задачи:", reply_markup=back_to_task_kb(tid, "⬅️ Назад"))
+
+@button("del", needs=BTN_TASK)
+async def btn_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, tid: int, data) -> None:
+    user_id = update.effective_user.id
+    _cancel_reminder(context.application, user_id, tid)
+    remove_task(data, tid)
+    save_tasks(user_id, data)
+    log_event("TASK: delete", user=user_id, tid=tid)
+    await list_cmd(update, context)
 
+@button("close", needs=BTN_TASK)
+async def btn_close(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, tid: int, data) -> None:
+    user_id = update.effective_user.id
+    _cancel_reminder(context.application, user_id, tid)
+    remove_task(data, tid)
+    data["stats"]["closed"] = int(data["stats"].get("closed", 0)) + 1
     save_tasks(user_id, data)
-    await safe_edit(q, task_line(t), reply_markup=task_kb(tid, t))
+    log_event("TASK: close", user=user_id, tid=tid)
+    await list_cmd(update, context)
 
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     awaiting = context.user_data.get("awaiting")
     if awaiting:
         mode = awaiting.get("mode")
-        data = load_tasks(user_id)
+        data = await load_tasks(user_id)
         if mode == "new":
             name, _ = parse_new_payload(update.message.text)
-            data["seq"] += 1
-            tid = data["seq"]
-            data["tasks"][str(tid)] = {"id": tid, "name": name, "progress": 0, "reminder_interval": None}
+            tid = add_task(data, name)
             save_tasks(user_id, data)
-            logger.info(f"TASK: create(user input) user={user_id} tid={tid} name={name}")
+            log_event("TASK: create", user=user_id, tid=tid, name=name, via="input")
             context.user_data["awaiting"] = None
             await update.message.reply_text(task_line(data["tasks"][str(tid)]), reply_markup=task_kb(tid, data["tasks"][str(tid)]))
             return
+        if mode == "import":
+            await run_import(update, context, *parse_import_text(update.message.text))
+            return
         if mode == "rename":
             tid = int(awaiting["id"])
             t = data["tasks"].get(str(tid))
             if t:
                 t["name"] = update.message.text.strip() or t["name"]
                 save_tasks(user_id, data)
-                logger.info(f"TASK: rename user={user_id} tid={tid} new_name={t['name']}")
+                log_event("TASK: rename", user=user_id, tid=tid, new_name=t["name"])
                 await update.message.reply_text(task_line(t), reply_markup=task_kb(tid, t))
             context.user_data["awaiting"] = None
             return
@@ -453,52 +2302,458 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     logger.error(f"ERROR: {err}")
 
-def _restore_reminders(app: Application) -> None:
-    for fp in DATA_DIR.glob("*.json"):
+async def _restore_reminders(app: Application) -> None:
+    # на старте читаем только индекс напоминаний и сохраняем их фазу (anchor + k*interval)
+    index = await run_io(storage.reminders_load)
+    if index is None:
+        # первый запуск с индексом: один раз строим его полным проходом по документам
+        for user_id in await run_io(lambda: list(storage.user_ids())):
+            data = await load_tasks(user_id)
+            for sid, t in data["tasks"].items():
+                interval = t.get("reminder_interval")
+                if interval:
+                    _schedule_reminder(app, user_id, int(sid), int(interval))
+        await run_io(storage.flush)
+        return
+    # ближайший срок выводим из якоря — фаза та же, индекс переписывать незачем. Срок, пропущенный
+    # за время простоя (известно из снимка состояния), отрабатываем, растянув такие напоминания на
+    # REM_RESTORE_SPREAD, чтобы не сработали одной волной. Без снимка (падение) пропущенное не догоняем.
+    now = time.time()
+    down_since = _state.get("saved_at")
+    late = []
+    for user_id, tid, interval, anchor in index:
+        next_due = anchor
+        if anchor <= now:
+            next_due = anchor + (int((now - anchor) // interval) + 1) * interval
+            if down_since is not None and next_due - interval > down_since:
+                late.append((next_due - interval, user_id, tid, interval))
+                continue
+        reminders.add(user_id, tid, interval, next_due)
+    late.sort()
+    step = REM_RESTORE_SPREAD / max(1, len(late))
+    for i, (_, user_id, tid, interval) in enumerate(late):
+        _schedule_reminder(app, user_id, tid, interval, first=1.0 + i * step)
+    logger.info(f"BOOT: reminders on time={len(index) - len(late)} overdue={len(late)} spread={REM_RESTORE_SPREAD:.0f}s")
+
+def _register_gauges() -> None:
+    metrics.gauge("taskbot_reminders_active", lambda: len(reminders), "Активные напоминания в движке")
+    metrics.gauge("taskbot_reminders_fired_total", lambda: reminders.fired, "Сработавшие напоминания", "counter")
+    metrics.gauge("taskbot_reminders_late_total", lambda: reminders.late, "Напоминания с опозданием > REM_LATE_SEC", "counter")
+    metrics.gauge("taskbot_send_queue_size", lambda: outbox._queue.qsize() if outbox._queue else 0, "Очередь отправки")
+    metrics.gauge("taskbot_send_sent_total", lambda: outbox.sent, "Отправленные сообщения", "counter")
+    metrics.gauge("taskbot_cache_docs", lambda: len(_cache._docs), "Документов в кэше")
+    metrics.gauge("taskbot_cache_dirty", lambda: len(_cache._dirty) + len(_cache._pending), "Грязных документов")
+    metrics.gauge("taskbot_edits_sent_total", lambda: edit_stats["sent"], "Отправленные правки сообщений", "counter")
+    metrics.gauge("taskbot_edits_avoided_total", lambda: edit_stats["avoided"], "Правки, пропущенные по отпечатку", "counter")
+    metrics.gauge("taskbot_loop_lag_seconds", lambda: loop_lag.last, "Последний замер задержки event loop")
+    metrics.gauge("taskbot_loop_lag_max_seconds", lambda: loop_lag.max, "Максимальная задержка event loop")
+    metrics.gauge("taskbot_log_dropped_total", lambda: log_queue.dropped, "Строки лога, потерянные при полной очереди", "counter")
+    metrics.gauge("taskbot_reminder_digests_total", lambda: digests.sent, "Сводки напоминаний", "counter")
+    metrics.gauge("taskbot_reminder_digest_items_total", lambda: digests.coalesced, "Напоминания, ушедшие в сводках", "counter")
+    if isinstance(storage, JournalStorage):
+        metrics.gauge("taskbot_journal_records_total", lambda: storage.records, "Записи журнала изменений", "counter")
+        metrics.gauge("taskbot_journal_commits_total", lambda: storage.commits, "Групповые fsync журнала", "counter")
+        metrics.gauge("taskbot_journal_compactions_total", lambda: storage.compactions, "Складывания журнала в снимки", "counter")
+    lag = metrics.histogram("taskbot_reminder_lag_seconds", LAG_BUCKETS, help="Опоздание срабатывания напоминаний")
+    reminders.lag_observers.append(lag.observe)
+
+_register_gauges()
+
+def _dump_metrics(text: str) -> None:
+    fp = DATA_DIR / "metrics.prom"
+    tmp = fp.with_suffix(".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    tmp.replace(fp)
+
+async def metrics_dump_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # рендер — в event loop (реестр без блокировок), в пул уходит только запись файла
+    await run_io(_dump_metrics, metrics.render())
+
+def make_app(token: Optional[str] = None, request: Optional[BaseRequest] = None) -> Application:
+    # request — подменный HTTP-бэкенд Bot API (bench.py гоняет хендлеры без Telegram)
+    token = token or TOKEN
+    if not token:
+        raise RuntimeError("Не задан TG_BOT_TOKEN в окружении.")
+    builder = (
+        Application.builder().token(token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(_on_startup)
+        .post_stop(_on_stop)
+        .post_shutdown(_on_shutdown)
+        .persistence(make_persistence())
+    )
+    if request is not None:
+        builder = builder.request(request)
+    if TG_API_URL:
+        builder = builder.base_url(TG_API_URL)
+    return builder.build()
+
+def register_handlers(app: Application) -> None:
+    app.add_handler(CommandHandler("start", per_user(start)))
+    app.add_handler(CommandHandler("help", per_user(help_cmd)))
+    app.add_handler(CommandHandler("new", per_user(new_cmd)))
+    app.add_handler(CommandHandler("list", per_user(list_cmd)))
+    app.add_handler(CommandHandler("stats", per_user(stats_cmd)))
+    app.add_handler(CommandHandler("debugrem", per_user(debugrem_cmd)))
+    app.add_handler(CommandHandler("import", per_user(import_cmd)))
+    app.add_handler(CommandHandler("export", per_user(export_cmd)))
+    app.add_handler(CallbackQueryHandler(per_user(on_buttons)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_user(on_text)))
+    app.add_handler(MessageHandler(filters.Document.ALL, per_user(on_document)))
+    app.add_error_handler(on_error)
+
+def schedule_jobs(app: Application) -> None:
+    app.job_queue.run_repeating(flush_job, interval=FLUSH_INTERVAL, first=FLUSH_INTERVAL, name="cache:flush")
+    app.job_queue.run_repeating(reminders_job, interval=REM_TICK, first=REM_TICK, name="rem:tick")
+    if isinstance(storage, JournalStorage):
+        every = min(JOURNAL_COMPACT_INTERVAL, 30.0)
+        app.job_queue.run_repeating(journal_compact_job, interval=every, first=every, name="journal:compact")
+
+# ---------- ВЕБХУК-СЕРВЕР ----------
+# Свой tornado-сервер вместо run_webhook: тот же порт принимает апдейты Telegram
+# и отдаёт /metrics. Tornado уже приходит с python-telegram-bot[webhooks].
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, app: Application) -> None:
+        self.app = app
+
+    async def post(self) -> None:
+        if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self.set_status(403)
+            return
         try:
-            user_id = int(fp.stem)
-        except ValueError:
+            payload = json.loads(self.request.body)
+            # от фронта (WORKERS > 1) приходит пачка апдейтов одного шарда — JSON-массив
+            updates = [Update.de_json(item, self.app.bot) for item in (payload if isinstance(payload, list) else [payload])]
+        except Exception as e:
+            logger.warning(f"WEBHOOK: bad update err={e}")
+            self.set_status(400)
+            return
+        for update in updates:
+            await self.app.update_queue.put(update)
+        self.set_status(200)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+async def serve_webhook(app: Application, public_url: Optional[str], port: int, path: str,
+                        host: str = "0.0.0.0") -> None:
+    # public_url=None — воркер за фронтом: вебхук в Telegram регистрирует фронт
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await app.initialize()
+    server = None
+    # с этого места любой сбой (например, set_webhook) всё равно закрывает хранилище и пул
+    try:
+        await app.post_init(app)
+        if public_url:
+            await app.bot.set_webhook(
+                url=f"{public_url}{path}",
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=DROP_PENDING_UPDATES,
+                secret_token=WEBHOOK_SECRET,
+            )
+        await app.start()
+        web = tornado.web.Application([
+            (path, WebhookHandler, {"app": app}),
+            (r"/metrics", MetricsHandler),
+        ])
+        server = tornado.httpserver.HTTPServer(web)
+        server.listen(port, host)
+        logger.info(f"BOOT: webhook on {host}:{port}{path}, metrics on :{port}/metrics")
+        await stop.wait()
+    finally:
+        if server is not None:
+            server.stop()
+        if app.running:
+            await app.stop()
+        await app.post_stop(app)   # гасит отправку и loop lag, даже если start() не дошёл
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+# ---------- ШАРДИРОВАНИЕ ПО ПРОЦЕССАМ ----------
+# WORKERS=N (N > 1) вместе с PUBLIC_URL: этот процесс становится лёгким фронтом. Он принимает
+# вебхуки Telegram, достаёт user_id и отдаёт апдейт воркеру user_id % N. Воркеры — такие же bot.py
+# на 127.0.0.1:WORKER_BASE_PORT+i, каждый со своим DATA_DIR/shard-<i>, своими напоминаниями и
+# своей долей SEND_RATE. В шард апдейты уходят строго по одному потоку пачками, поэтому порядок
+# апдейтов одного пользователя сохраняется. /metrics фронта — только счётчики маршрутизации,
+# метрики воркеров — на их портах.
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_INDEX = os.getenv("WORKER_INDEX")             # задаёт фронт при запуске воркера
+FRONT_BATCH = int(os.getenv("FRONT_BATCH", "100"))  # апдейтов в одном POST воркеру
+FRONT_QUEUE_MAX = int(os.getenv("FRONT_QUEUE_MAX", "10000"))
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "30"))
+# упавший воркер перезапускается с паузой 1, 2, 4 … WORKER_BACKOFF_MAX с; после WORKER_MAX_CRASHES
+# падений подряд (прожил меньше WORKER_STABLE_SEC) шард считается мёртвым и больше не поднимается
+WORKER_BACKOFF_MAX = float(os.getenv("WORKER_BACKOFF_MAX", "60"))
+WORKER_MAX_CRASHES = int(os.getenv("WORKER_MAX_CRASHES", "8"))
+WORKER_STABLE_SEC = float(os.getenv("WORKER_STABLE_SEC", "60"))
+SHARDS_FILE = DATA_DIR / "shards.json"
+
+def shard_of(user_id: int, shards: int) -> int:
+    return user_id % shards
+
+def shard_dir(index: int) -> Path:
+    return DATA_DIR / f"shard-{index}"
+
+def update_user_id(payload: Dict[str, Any]) -> int:
+    # апдейт Bot API — один объект рядом с update_id; пользователь — from/user, иначе чат
+    for key, obj in payload.items():
+        if key == "update_id" or not isinstance(obj, dict):
             continue
-        data = load_tasks(user_id)
-        for sid, t in data["tasks"].items():
-            interval = t.get("reminder_interval")
-            if interval:
-                _schedule_reminder(app, user_id, int(sid), int(interval))
+        who = obj.get("from") or obj.get("user") or obj.get("chat")
+        if who and "id" in who:
+            return int(who["id"])
+    return 0
 
-def make_app() -> Application:
-    return Application.builder().token(TOKEN).build()
+def prepare_shards(shards: int) -> None:
+    if SHARDS_FILE.exists():
+        have = _loads(SHARDS_FILE.read_bytes()).get("workers")
+        if have != shards:
+            raise RuntimeError(f"DATA_DIR уже разбит на {have} шардов, а WORKERS={shards}: перешардирование не поддерживается")
+        return
+    # первый запуск с шардами: документы из корня DATA_DIR раскладываются по шардам,
+    # корень остаётся как был (резервная копия); индексы напоминаний шарды построят сами
+    targets = [make_storage(shard_dir(i)) for i in range(shards)]
+    moved = 0
+    for user_id in list(storage.user_ids()):
+        targets[shard_of(user_id, shards)].save(user_id, storage.load(user_id))
+        moved += 1
+    for target in targets:
+        target.close()
+    SHARDS_FILE.write_bytes(_dumps({"workers": shards, "moved": moved}))
+    logger.info(f"SHARD: split DATA_DIR into {shards} shards, docs={moved}")
 
-def main() -> None:
-    app = make_app()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("new", new_cmd))
-    app.add_handler(CommandHandler("list", list_cmd))
-    app.add_handler(CommandHandler("stats", stats_cmd))
-    app.add_handler(CommandHandler("debugrem", debugrem_cmd))
-    app.add_handler(CallbackQueryHandler(on_buttons))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
-    app.add_error_handler(on_error)
+class WorkerPool:
+    # Процессы-воркеры: запуск, перезапуск упавших, остановка через SIGTERM
+    def __init__(self, shards: int, base_port: int, path: str) -> None:
+        self.shards = shards
+        self.base_port = base_port
+        self.path = path
+        self.procs: List[Optional[subprocess.Popen]] = [None] * shards
+        self.started = [0.0] * shards
+        self.crashes = [0] * shards          # падений подряд
+        self.retry_at = [0.0] * shards       # когда перезапускать упавший воркер
+        self.dead = [False] * shards         # упёрся в WORKER_MAX_CRASHES
+        self.restarts = 0
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
 
-    _restore_reminders(app)
-    logger.info("BOOT: app started, reminders restored")
+    def url(self, index: int) -> str:
+        return f"http://127.0.0.1:{self.base_port + index}{self.path}"
 
-    public_url = os.getenv("PUBLIC_URL")
-    if public_url:
-        # РЕЖИМ ВЕБХУКОВ. НИКАКОГО POLLING при наличии PUBLIC_URL.
-        port = int(os.getenv("PORT", "10000"))
-        path = os.getenv("WEBHOOK_PATH", "/hook")
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=port,
-            url_path=path,
-            webhook_url=f"{public_url}{path}",
-            drop_pending_updates=True,
+    def _spawn(self, index: int) -> None:
+        env = dict(os.environ)
+        env.pop("PUBLIC_URL", None)
+        env.update({
+            "WORKER_INDEX": str(index),
+            "DATA_DIR": str(shard_dir(index)),
+            "PORT": str(self.base_port + index),
+            "WEBHOOK_PATH": self.path,
+            "SEND_RATE": str(SEND_RATE / self.shards),   # общий лимит Telegram делится на всех
+        })
+        self.procs[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        self.started[index] = time.monotonic()
+        logger.info(f"SHARD: worker {index} pid={self.procs[index].pid} port={self.base_port + index}")
+
+    def start(self) -> None:
+        for i in range(self.shards):
+            self._spawn(i)
+        self._task = asyncio.create_task(self._watch())
+
+    def alive(self, index: int) -> bool:
+        proc = self.procs[index]
+        return proc is not None and proc.poll() is None
+
+    async def _watch(self) -> None:
+        while not self._stopping:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for i, proc in enumerate(self.procs):
+                if self._stopping or self.dead[i] or self.alive(i):
+                    continue
+                if self.retry_at[i]:
+                    if now >= self.retry_at[i]:
+                        self.retry_at[i] = 0.0
+                        self.restarts += 1
+                        self._spawn(i)
+                    continue
+                # только что обнаружили падение
+                self.crashes[i] = 1 if now - self.started[i] >= WORKER_STABLE_SEC else self.crashes[i] + 1
+                code = proc.returncode if proc is not None else None
+                if self.crashes[i] > WORKER_MAX_CRASHES:
+                    self.dead[i] = True
+                    logger.error(f"SHARD: worker {i} crashed {self.crashes[i] - 1} times in a row (code={code}), giving up")
+                    continue
+                delay = min(WORKER_BACKOFF_MAX, 2.0 ** (self.crashes[i] - 1))
+                self.retry_at[i] = now + delay
+                logger.warning(f"SHARD: worker {i} exited code={code}, restart in {delay:.0f}s (crash {self.crashes[i]})")
+
+    async def stop(self) -> None:
+        self._stopping = True
+        if self._task:
+            self._task.cancel()
+        live = [p for p in self.procs if p is not None and p.poll() is None]
+        for proc in live:
+            proc.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for proc in live:
+            while proc.poll() is None and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            if proc.poll() is None:
+                logger.warning(f"SHARD: worker pid={proc.pid} did not stop, killing")
+                proc.kill()
+
+class ShardRouter:
+    # По очереди на шард; один форвардер на очередь шлёт сырые тела апдейтов пачкой (JSON-массив)
+    # и повторяет ту же пачку, пока воркер не примет её, — так порядок не ломается.
+    def __init__(self, pool: WorkerPool) -> None:
+        self.pool = pool
+        self.queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=FRONT_QUEUE_MAX) for _ in range(pool.shards)]
+        self._tasks: List[asyncio.Task] = []
+        self._client = tornado.httpclient.AsyncHTTPClient()
+
+    def route(self, body: bytes, payload: Dict[str, Any]) -> bool:
+        shard = shard_of(update_user_id(payload), self.pool.shards)
+        if not self.pool.alive(shard):
+            # воркер лежит или ждёт перезапуска — пусть Telegram повторит доставку позже
+            metrics.counter("taskbot_front_rejected_total", "Апдейты, не принятые фронтом", reason="worker_down").inc()
+            return False
+        try:
+            self.queues[shard].put_nowait(body)
+        except asyncio.QueueFull:
+            metrics.counter("taskbot_front_rejected_total", "Апдейты, не принятые фронтом", reason="queue_full").inc()
+            return False
+        metrics.counter("taskbot_front_updates_total", "Апдейты, принятые фронтом", shard=shard).inc()
+        return True
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._forward(i)) for i in range(self.pool.shards)]
+
+    async def _forward(self, index: int) -> None:
+        queue = self.queues[index]
+        headers = {"Content-Type": "application/json"}
+        if WEBHOOK_SECRET:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = WEBHOOK_SECRET
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < FRONT_BATCH and not queue.empty():
+                batch.append(queue.get_nowait())
+            body = b"[" + b",".join(batch) + b"]"
+            delay = 0.1
+            while True:
+                try:
+                    await self._client.fetch(self.pool.url(index), method="POST", body=body,
+                                             headers=headers, request_timeout=30)
+                    break
+                except Exception as e:
+                    # воркер ещё стартует или перезапускается — ждём его, пачку не теряем
+                    logger.warning(f"SHARD: forward to worker {index} failed ({e}), retry in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5.0)
+            metrics.counter("taskbot_front_batches_total", "Пачки, отданные воркерам", shard=index).inc()
+            for _ in batch:
+                queue.task_done()
+
+    async def drain(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"SHARD: {sum(q.qsize() for q in self.queues)} updates not forwarded on stop")
+        for task in self._tasks:
+            task.cancel()
+
+class FrontHandler(tornado.web.RequestHandler):
+    def initialize(self, router: ShardRouter) -> None:
+        self.router = router
+
+    def post(self) -> None:
+        if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self.set_status(403)
+            return
+        try:
+            payload = json.loads(self.request.body)
+        except Exception as e:
+            logger.warning(f"WEBHOOK: bad update err={e}")
+            self.set_status(400)
+            return
+        # 503 — Telegram повторит доставку позже
+        self.set_status(200 if self.router.route(self.request.body, payload) else 503)
+
+async def serve_front(public_url: str, port: int, path: str) -> None:
+    if not TOKEN:
+        raise RuntimeError("Не задан TG_BOT_TOKEN в окружении.")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    pool = WorkerPool(WORKERS, int(os.getenv("WORKER_BASE_PORT", str(port + 1))), path)
+    router = ShardRouter(pool)
+    metrics.gauge("taskbot_front_queue_depth", lambda: sum(q.qsize() for q in router.queues),
+                  "Апдейты в очередях шардов")
+    metrics.gauge("taskbot_front_worker_restarts", lambda: pool.restarts, "Перезапуски воркеров", kind="counter")
+    metrics.gauge("taskbot_front_workers_down", lambda: sum(not pool.alive(i) for i in range(pool.shards)),
+                  "Воркеры, которые сейчас не работают")
+    pool.start()
+    router.start()
+    web = tornado.web.Application([
+        (path, FrontHandler, {"router": router}),
+        (r"/metrics", MetricsHandler),
+    ])
+    server = tornado.httpserver.HTTPServer(web)
+    server.listen(port, "0.0.0.0")
+    bot = Bot(TOKEN, base_url=TG_API_URL or "https://api.telegram.org/bot")
+    async with bot:
+        await bot.set_webhook(
+            url=f"{public_url}{path}",
             allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+            secret_token=WEBHOOK_SECRET,
         )
+    logger.info(f"BOOT: front on :{port}{path}, workers={WORKERS}")
+    try:
+        await stop.wait()
+    finally:
+        server.stop()
+        await router.drain(WORKER_STOP_TIMEOUT)
+        await pool.stop()
+        logger.info("SHUTDOWN: front stopped")
+
+def main() -> None:
+    public_url = os.getenv("PUBLIC_URL")
+    port = int(os.getenv("PORT", "10000"))
+    path = os.getenv("WEBHOOK_PATH", "/hook")
+    if public_url and WORKERS > 1 and WORKER_INDEX is None:
+        prepare_shards(WORKERS)
+        asyncio.run(serve_front(public_url, port, path))
+        return
+    if WORKER_INDEX is None and SHARDS_FILE.exists():
+        # живые данные — в shard-*, корень DATA_DIR остался копией на момент разбиения
+        have = _loads(SHARDS_FILE.read_bytes()).get("workers")
+        raise RuntimeError(f"DATA_DIR разбит на {have} шардов: запускайте с PUBLIC_URL и WORKERS={have}, "
+                           "одним процессом перешардирование не поддерживается")
+
+    app = make_app()
+    register_handlers(app)
+    schedule_jobs(app)
+    logger.info("BOOT: app configured")
+
+    if WORKER_INDEX is not None:
+        # воркер за фронтом: слушает только локально, вебхук в Telegram не трогает
+        asyncio.run(serve_webhook(app, None, port, path, host="127.0.0.1"))
+    elif public_url:
+        # РЕЖИМ ВЕБХУКОВ. НИКАКОГО POLLING при наличии PUBLIC_URL.
+        asyncio.run(serve_webhook(app, public_url, port, path))
     else:
-        # Локальный режим (например, на твоём ПК)
-        app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+        # Локальный режим (например, на твоём ПК); метрики — в файл, если попросили
+        if METRICS_DUMP_INTERVAL > 0:
+            app.job_queue.run_repeating(metrics_dump_job, interval=METRICS_DUMP_INTERVAL, name="metrics:dump")
+        app.run_polling(drop_pending_updates=DROP_PENDING_UPDATES, allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()